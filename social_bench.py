@@ -0,0 +1,186 @@
+"""Benchmark harness for ``social_p2p``.
+
+Starts an in-process network of ``Peer`` instances on localhost, drives a
+few workloads against it and prints the results as JSON, e.g.::
+
+    python social_bench.py --peers 20 --workloads publish fanout messages likes
+"""
+import asyncio
+import json
+import logging
+import random
+import tempfile
+import time
+from pathlib import Path
+from social_p2p import Peer
+
+BASE_PORT = 9500
+WORKLOADS = ('publish', 'fanout', 'messages', 'likes')
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class WireCounter:
+    """Count datagrams and bytes a peer sends."""
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+
+    def install(self, transport):
+        sendto = transport.sendto
+
+        def counted(data, addr=None):
+            self.packets += 1
+            self.bytes += len(data)
+            return sendto(data, addr)
+        transport.sendto = counted
+
+
+class Network:
+    def __init__(self, size, base_port=BASE_PORT, cache=True):
+        self.size = size
+        self.base_port = base_port
+        self.cache = cache
+        self.peers = []
+        self.wire = WireCounter()
+        # Signing keys go here rather than into the user's data directory.
+        self.data_dir = tempfile.TemporaryDirectory(prefix='social_bench_')
+
+    async def start(self):
+        for i in range(self.size):
+            peer = Peer(f'bench{i}', port=self.base_port + i, data_dir=Path(self.data_dir.name))
+            if not self.cache:
+                peer.cache.max_entries = 0
+            # Join the nodes into a ring: each bootstraps from its predecessor
+            # and the first node closes the ring once everyone is up.
+            await peer.start(f'127.0.0.1:{self.peers[-1].port}' if self.peers else None)
+            self.wire.install(peer.server.transport)
+            self.peers.append(peer)
+        await self.peers[0].server.bootstrap([('127.0.0.1', self.peers[-1].port)])
+        await self.peers[0].publish_profile()
+
+    def stop(self):
+        for peer in self.peers:
+            peer.server.stop()
+        self.data_dir.cleanup()
+
+
+async def timed(samples, coro):
+    start = time.perf_counter()
+    result = await coro
+    samples.append(time.perf_counter() - start)
+    return result
+
+
+async def publish(net, rounds):
+    samples = []
+    failed = 0
+    for n in range(rounds):
+        posts = await asyncio.gather(*(timed(samples, p.add_post(f'post {n} from {p.username}'))
+                                       for p in net.peers))
+        failed += sum(post is None for post in posts)
+    return samples, {'failed': failed}
+
+
+async def fanout(net, rounds):
+    samples = []
+    users = [p.username for p in net.peers]
+
+    async def read_all(peer):
+        async for _ in peer.fetch_posts_many(users, limit=20):
+            pass
+
+    for _ in range(rounds):
+        await asyncio.gather(*(timed(samples, read_all(p)) for p in net.peers))
+    return samples, {}
+
+
+async def messages(net, rounds):
+    samples = []
+    sent = {p.username: 0 for p in net.peers}
+    failed = 0
+    for n in range(rounds):
+        jobs = []
+        for peer in net.peers:
+            target = random.choice(net.peers).username
+            sent[target] += 1
+            jobs.append(timed(samples, peer.send_message(target, f'msg {n}')))
+        failed += sum(msg_id is None for msg_id in await asyncio.gather(*jobs))
+    received = 0
+    for peer in net.peers:
+        received += len(await peer.fetch_messages())
+    total = sum(sent.values())
+    # Messages whose send reported a failed write are not counted as lost.
+    return samples, {'sent': total, 'failed': failed, 'received': received,
+                     'lost': total - failed - received}
+
+
+async def likes(net, rounds):
+    samples = []
+    author = net.peers[0]
+    post = await author.add_post('like me')
+    if post is None:
+        raise RuntimeError('The post to like could not be stored')
+    for _ in range(rounds):
+        await asyncio.gather(*(timed(samples, p.like_post(author.username, post.id))
+                               for p in net.peers))
+    expected = rounds * len(net.peers)
+    author.cache.clear()
+    posts = await author.fetch_posts(author.username, limit=1)
+    counted = posts[-1].likes if posts else 0
+    return samples, {'expected': expected, 'counted': counted, 'lost': expected - counted}
+
+
+async def run(args):
+    net = Network(args.peers, args.base_port, cache=not args.no_cache)
+    start = time.perf_counter()
+    await net.start()
+    report = {'peers': args.peers, 'rounds': args.rounds,
+              'startup_s': round(time.perf_counter() - start, 4), 'workloads': {}}
+    for name in args.workloads:
+        before_packets, before_bytes = net.wire.packets, net.wire.bytes
+        start = time.perf_counter()
+        samples, extra = await globals()[name](net, args.rounds)
+        elapsed = time.perf_counter() - start
+        report['workloads'][name] = dict({
+            'ops': len(samples),
+            'elapsed_s': round(elapsed, 4),
+            'throughput_ops_s': round(len(samples) / elapsed, 2) if elapsed else None,
+            'p50_ms': round(percentile(samples, 50) * 1000, 3) if samples else None,
+            'p99_ms': round(percentile(samples, 99) * 1000, 3) if samples else None,
+            'packets': net.wire.packets - before_packets,
+            'bytes': net.wire.bytes - before_bytes,
+        }, **extra)
+    net.stop()
+    return report
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark an in-process social_p2p network')
+    parser.add_argument('--peers', type=int, default=10, help='Number of peers to start')
+    parser.add_argument('--rounds', type=int, default=5, help='Rounds per workload')
+    parser.add_argument('--base-port', type=int, default=BASE_PORT, help='First UDP port to use')
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument('--no-cache', action='store_true', help='Disable the local read cache')
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
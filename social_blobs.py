@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import zlib
+from pathlib import Path
+import umsgpack
+import social_codec as codec
+
+# Bytes per chunk; a stored chunk must fit in one Kademlia UDP datagram.
+BLOB_CHUNK_SIZE = 6144
+# Chunk digests listed per manifest record before another level is added.
+MANIFEST_FANOUT = 128
+# Manifest levels a blob may have; 128**4 chunks is far beyond any upload.
+MANIFEST_MAX_DEPTH = 4
+BLOB_CONCURRENCY = 8
+REF_PREFIX = 'blob:'
+
+
+def is_blob_ref(value):
+    return isinstance(value, str) and value.startswith(REF_PREFIX)
+
+
+class BlobStore:
+    """Content-addressed blobs split into chunks across the DHT.
+
+    Every chunk is stored under ``blobchunk:<sha256>``. A blob's manifest,
+    stored under ``blob:<sha256 of the data>``, lists its chunk digests; very
+    large blobs get manifests of manifests. Fetched chunks are verified
+    against their digest and kept in ``cache_dir``, so an interrupted
+    download resumes where it stopped.
+    """
+
+    def __init__(self, get, set, cache_dir: Path | None = None, concurrency=BLOB_CONCURRENCY):
+        self.get_value = get
+        self.set_value = set
+        self.cache_dir = cache_dir
+        self.limit = asyncio.Semaphore(concurrency)
+
+    # -------- Local chunk cache ---------
+
+    def _cached(self, digest: bytes):
+        if not self.cache_dir:
+            return None
+        path = self.cache_dir / digest.hex()
+        if path.exists():
+            data = path.read_bytes()
+            if hashlib.sha256(data).digest() == digest:
+                return data
+        return None
+
+    def _remember(self, digest: bytes, data: bytes):
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_dir / (digest.hex() + '.tmp')
+            tmp.write_bytes(data)
+            tmp.replace(self.cache_dir / digest.hex())
+
+    # -------- Upload ---------
+
+    async def _put_chunk(self, data: bytes):
+        """Store one chunk and return its digest; ``None`` if the write failed."""
+        digest = hashlib.sha256(data).digest()
+        self._remember(digest, data)
+        async with self.limit:
+            if not await self.set_value(f'blobchunk:{digest.hex()}', data):
+                return None
+        return digest
+
+    async def put(self, data: bytes):
+        """Store ``data`` and return a ``blob:<sha256>`` reference to it.
+
+        Returns ``None`` when any part did not reach the DHT; chunks that
+        did are simply stored again by the next attempt.
+        """
+        digests = await asyncio.gather(
+            *(self._put_chunk(data[i:i + BLOB_CHUNK_SIZE])
+              for i in range(0, len(data), BLOB_CHUNK_SIZE)))
+        depth = 0
+        while len(digests) > MANIFEST_FANOUT and None not in digests:
+            groups = [digests[i:i + MANIFEST_FANOUT] for i in range(0, len(digests), MANIFEST_FANOUT)]
+            digests = await asyncio.gather(
+                *(self._put_chunk(codec.encode(None, group)) for group in groups))
+            depth += 1
+        if None in digests:
+            return None
+        ref = REF_PREFIX + hashlib.sha256(data).hexdigest()
+        manifest = {'size': len(data), 'depth': depth, 'chunks': list(digests)}
+        if not await self.set_value(ref, codec.encode(None, manifest)):
+            return None
+        return ref
+
+    # -------- Download ---------
+
+    async def _get_chunk(self, digest: bytes):
+        data = self._cached(digest)
+        if data is not None:
+            return data
+        async with self.limit:
+            data = await self.get_value(f'blobchunk:{digest.hex()}')
+        if data is None:
+            raise LookupError(f'Missing blob chunk {digest.hex()}')
+        if hashlib.sha256(data).digest() != digest:
+            raise ValueError(f'Corrupt blob chunk {digest.hex()}')
+        self._remember(digest, data)
+        return data
+
+    async def get(self, ref: str):
+        """Fetch and verify the blob behind ``ref``; ``None`` if unknown."""
+        digest = bytes.fromhex(ref[len(REF_PREFIX):])
+        data = self._cached(digest)
+        if data is not None:
+            return data
+        raw = await self.get_value(ref)
+        if not raw:
+            return None
+        # Anyone can write the manifest; the data is checked against the ref.
+        try:
+            manifest = codec.decode(raw)
+            digests = manifest['chunks']
+            if manifest['depth'] not in range(MANIFEST_MAX_DEPTH + 1):
+                raise ValueError(f'Corrupt blob {ref}')
+            for _ in range(manifest['depth']):
+                groups = await asyncio.gather(*(self._get_chunk(d) for d in digests))
+                digests = [d for group in groups for d in codec.decode(group)]
+            data = b''.join(await asyncio.gather(*(self._get_chunk(d) for d in digests)))
+        except (TypeError, KeyError, AttributeError, zlib.error, umsgpack.UnpackException) as exc:
+            raise ValueError(f'Corrupt blob {ref}') from exc
+        if len(data) != manifest['size'] or hashlib.sha256(data).digest() != digest:
+            raise ValueError(f'Corrupt blob {ref}')
+        self._remember(digest, data)
+        return data
@@ -0,0 +1,109 @@
+import base64
+import json
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+# Seconds each kind of record stays fresh. Profiles rarely change, addresses
+# may move, timeline heads change with every post. Chunks are additionally
+# versioned by how many posts they held when cached.
+DEFAULT_TTLS = {
+    'profile': 600,
+    'address': 30,
+    'head': 10,
+    'chunk': 600,
+    'likes': 10,
+}
+DEFAULT_MAX_ENTRIES = 2048
+
+
+class Cache:
+    """Bounded LRU cache of raw DHT values with per-kind TTLs.
+
+    Entries are keyed by ``(kind, key)``. A ``version`` may be stored with a
+    value; lookups that pass a different version miss. When ``path`` is
+    given the cache can be saved to and restored from disk so restarts are
+    warm.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttls=None, path: Path | None = None):
+        self.max_entries = max_entries
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, kind, key, version=None):
+        entry = self.entries.get((kind, key))
+        if entry is not None:
+            expires, entry_version, value = entry
+            if expires > time.time() and entry_version == version:
+                self.entries.move_to_end((kind, key))
+                self.hits[kind] = self.hits.get(kind, 0) + 1
+                return value
+            del self.entries[(kind, key)]
+        self.misses[kind] = self.misses.get(kind, 0) + 1
+        return None
+
+    def put(self, kind, key, value, version=None):
+        if value is None:
+            return
+        self.entries[(kind, key)] = (time.time() + self.ttls.get(kind, 60), version, value)
+        self.entries.move_to_end((kind, key))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def values(self, kind):
+        """All values of ``kind`` held, fresh or not."""
+        return [value for (entry_kind, _), (_, _, value) in self.entries.items()
+                if entry_kind == kind]
+
+    def invalidate(self, kind, key):
+        self.entries.pop((kind, key), None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        kinds = sorted(set(self.hits) | set(self.misses))
+        return {
+            'entries': len(self.entries),
+            'hits': sum(self.hits.values()),
+            'misses': sum(self.misses.values()),
+            'by_kind': {k: {'hits': self.hits.get(k, 0), 'misses': self.misses.get(k, 0)}
+                        for k in kinds},
+        }
+
+    def load(self):
+        if not self.path or not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                rows = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for row in rows if isinstance(rows, list) else []:
+            try:
+                kind, key, expires, version, value = row
+                if isinstance(value, dict):
+                    value = base64.b64decode(value['b64'])
+                if expires > now:
+                    self.entries[(kind, key)] = (expires, version, value)
+            except (TypeError, ValueError, KeyError):
+                continue  # a damaged row; the value is simply fetched again
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if not self.path:
+            return
+        now = time.time()
+        rows = [[kind, key, expires, version,
+                 {'b64': base64.b64encode(value).decode('ascii')} if isinstance(value, bytes) else value]
+                for (kind, key), (expires, version, value) in self.entries.items()
+                if expires > now]
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(rows, f)
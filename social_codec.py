@@ -0,0 +1,118 @@
+import json
+import zlib
+import dataclasses
+import umsgpack
+
+# Binary values start with MAGIC so they can never be mistaken for the JSON
+# records ('{' or '[') written by older versions.
+MAGIC = b'\xfe'
+VERSION = 1
+FLAG_LIST = 0x01
+FLAG_ZLIB = 0x02
+# Payloads at least this large are compressed when that makes them smaller.
+COMPRESS_MIN = 256
+
+# kind -> (tag, field names, defaults); tag -> kind
+SCHEMAS = {}
+TAGS = {}
+RAW_TAG = 0
+
+
+def register(kind, tag, fields, defaults=None):
+    """Register a record schema.
+
+    Records are dicts. Fields are encoded by their position in ``fields`` and
+    left out when equal to their default, so new fields must only ever be
+    appended.
+    """
+    SCHEMAS[kind] = (tag, tuple(fields), dict(defaults or {}))
+    TAGS[tag] = kind
+
+
+def register_dataclass(kind, tag, cls):
+    fields, defaults = [], {}
+    for f in dataclasses.fields(cls):
+        fields.append(f.name)
+        if f.default is not dataclasses.MISSING:
+            defaults[f.name] = f.default
+        elif f.default_factory is not dataclasses.MISSING:
+            defaults[f.name] = f.default_factory()
+    register(kind, tag, fields, defaults)
+
+
+def _pack_record(schema, record):
+    _, fields, defaults = schema
+    packed = {}
+    for i, name in enumerate(fields):
+        if name in record and (name not in defaults or record[name] != defaults[name]):
+            packed[i] = record[name]
+    return packed
+
+
+def _unpack_record(schema, packed):
+    _, fields, defaults = schema
+    record = {}
+    for i, name in enumerate(fields):
+        if i in packed:
+            record[name] = packed[i]
+        elif name in defaults:
+            default = defaults[name]
+            record[name] = default.copy() if isinstance(default, (dict, list)) else default
+    return record
+
+
+def encode(kind, value):
+    """Encode a record, or a list of records, of ``kind`` to bytes.
+
+    ``kind=None`` stores plain msgpack data without a schema.
+    """
+    flags = 0
+    if kind is None:
+        tag, body = RAW_TAG, value
+    else:
+        schema = SCHEMAS[kind]
+        tag = schema[0]
+        if isinstance(value, list):
+            flags |= FLAG_LIST
+            body = [_pack_record(schema, r) for r in value]
+        else:
+            body = _pack_record(schema, value)
+    payload = umsgpack.packb(body)
+    if len(payload) >= COMPRESS_MIN:
+        squeezed = zlib.compress(payload)
+        if len(squeezed) < len(payload):
+            flags |= FLAG_ZLIB
+            payload = squeezed
+    return MAGIC + bytes((VERSION, tag, flags)) + payload
+
+
+def kind_of(value):
+    """The registered kind of an encoded record, or ``None``."""
+    if isinstance(value, bytes) and value[:1] == MAGIC and len(value) > 3:
+        return TAGS.get(value[2])
+    return None
+
+
+def decode(value):
+    """Decode a value written by :func:`encode` or a legacy JSON string."""
+    if isinstance(value, bytes) and value[:1] == MAGIC:
+        if len(value) < 4:
+            raise ValueError('Truncated record')
+        version, tag, flags = value[1], value[2], value[3]
+        if version > VERSION:
+            raise ValueError(f'Unsupported record version {version}')
+        payload = value[4:]
+        if flags & FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+        body = umsgpack.unpackb(payload)
+        if tag == RAW_TAG:
+            return body
+        if tag not in TAGS:
+            raise ValueError(f'Unknown record tag {tag}')
+        schema = SCHEMAS[TAGS[tag]]
+        if flags & FLAG_LIST:
+            return [_unpack_record(schema, r) for r in body]
+        return _unpack_record(schema, body)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return json.loads(value)
@@ -0,0 +1,261 @@
+"""Long-running host for one or more ``Peer`` identities.
+
+The daemon keeps its peers started on a single event loop and answers
+JSON-line requests on a local Unix socket, so CLI commands run against a
+warm routing table instead of starting a node each time. Start it with
+``python social_p2p.py --username alice --daemon``.
+"""
+import asyncio
+import json
+import os
+import signal
+import socket
+from dataclasses import asdict
+from pathlib import Path
+from social_p2p import Peer, Retention, DEFAULT_PORT
+from social_metrics import Metrics
+
+SOCKET_NAME = 'daemon.sock'
+CLIENT_TIMEOUT = 60
+
+
+# -------- Operations ---------
+# Every operation takes a started peer plus JSON parameters and returns a
+# JSON-serialisable result. The CLI runs the same table in-process when no
+# daemon is around.
+
+async def op_post(peer, text):
+    post = await peer.add_post(text)
+    return asdict(post) if post else None
+
+
+async def op_get_posts(peer, users, limit=None, since=None):
+    results = {}
+    async for user, posts in peer.fetch_posts_many(users, limit=limit, since=since):
+        results[user] = [asdict(p) for p in posts]
+    return results
+
+
+async def op_like(peer, user, post_id):
+    return await peer.like_post(user, post_id)
+
+
+async def op_lookup(peer, user):
+    profile, addr = await peer.lookup_user(user)
+    return {'profile': asdict(profile) if profile else None, 'address': addr}
+
+
+async def op_message(peer, user, text):
+    return await peer.send_message(user, text)
+
+
+async def op_fetch(peer):
+    return await peer.fetch_messages()
+
+
+async def op_follow(peer, user):
+    await peer.follow(user)
+
+
+async def op_unfollow(peer, user):
+    await peer.unfollow(user)
+
+
+async def op_feed(peer, limit=20):
+    async for _ in peer.feed.refresh():
+        pass
+    return [asdict(p) for p in peer.feed.page(limit)]
+
+
+async def op_update_profile(peer, fields=None, media=None):
+    failed = [field_name for field_name, filename in (media or {}).items()
+              if not await peer.set_media(field_name, Path(filename).read_bytes())]
+    peer.update_profile(**(fields or {}))
+    await peer.publish_profile()
+    return failed
+
+
+async def op_get_media(peer, user, field, filename):
+    profile, _ = await peer.lookup_user(user)
+    data = await peer.fetch_media(profile, field) if profile else None
+    if not data:
+        return 0
+    Path(filename).write_bytes(data)
+    return len(data)
+
+
+async def op_profile(peer):
+    return asdict(peer.profile)
+
+
+async def op_search(peer, query, limit=20):
+    return {'users': peer.search.users(query, limit),
+            'matches': [{'kind': kind, 'record': asdict(record)}
+                        for kind, record in peer.search.search(query, limit)]}
+
+
+async def op_maintain(peer):
+    return await peer.maintain()
+
+
+async def op_stats(peer):
+    return {'operations': peer.hooks.snapshot() if isinstance(peer.hooks, Metrics) else None,
+            'cache': peer.cache.stats(), 'startup': peer.startup, 'search': peer.search.stats(),
+            'signatures': peer.verifier.stats()}
+
+
+OPERATIONS = {
+    'post': op_post,
+    'get_posts': op_get_posts,
+    'like': op_like,
+    'lookup': op_lookup,
+    'message': op_message,
+    'fetch': op_fetch,
+    'follow': op_follow,
+    'unfollow': op_unfollow,
+    'feed': op_feed,
+    'update_profile': op_update_profile,
+    'get_media': op_get_media,
+    'profile': op_profile,
+    'search': op_search,
+    'maintain': op_maintain,
+    'stats': op_stats,
+}
+
+
+async def dispatch(peer, method, params):
+    operation = OPERATIONS.get(method)
+    if operation is None:
+        raise ValueError(f'Unknown method {method}')
+    return await operation(peer, **params)
+
+
+# -------- Server ---------
+
+class Daemon:
+    def __init__(self, data_dir: Path, socket_path: Path | None = None, stats=False,
+                 retention=None):
+        self.data_dir = data_dir
+        self.socket_path = socket_path or data_dir / SOCKET_NAME
+        self.stats = stats
+        self.retention = retention
+        self.peers = {}
+        self.server = None
+
+    async def start_identity(self, username, port=DEFAULT_PORT, bootstrap=None, retention=None):
+        """Host ``username`` if it is not hosted yet; returns its port.
+
+        Without ``bootstrap`` a further identity joins through one already
+        hosted. ``retention`` (``Retention`` fields) also applies to a peer
+        hosted before.
+        """
+        retention = Retention(**retention) if retention is not None else None
+        peer = self.peers.get(username)
+        if peer is not None and retention is not None:
+            peer.retention = retention
+        if peer is None:
+            if bootstrap is None and self.peers:
+                bootstrap = f'127.0.0.1:{next(iter(self.peers.values())).port}'
+            peer = Peer(username, port=port, profile_path=self.data_dir / f'{username}_profile.json',
+                        hooks=Metrics() if self.stats else None,
+                        retention=retention or self.retention)
+            try:
+                await peer.start(bootstrap)
+            except BaseException:
+                peer.stop()  # e.g. the port is taken; release its files
+                raise
+            self.peers[username] = peer
+        return peer.port
+
+    def stop_identity(self, username):
+        peer = self.peers.pop(username, None)
+        if peer:
+            peer.stop()
+        return peer is not None
+
+    async def handle_request(self, request):
+        user = request.get('user')
+        method = request.get('method')
+        params = request.get('params') or {}
+        if method == 'start':
+            return await self.start_identity(user, **params)
+        if method == 'stop':
+            return self.stop_identity(user)
+        if method == 'identities':
+            return sorted(self.peers)
+        peer = self.peers.get(user)
+        if peer is None:
+            raise LookupError(f'{user} is not hosted by this daemon')
+        return await dispatch(peer, method, params)
+
+    async def handle_client(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    reply = {'ok': True, 'result': await self.handle_request(json.loads(line))}
+                except Exception as exc:
+                    reply = {'ok': False, 'error': f'{type(exc).__name__}: {exc}'}
+                writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        self.server = await asyncio.start_unix_server(self.handle_client, path=str(self.socket_path))
+        os.chmod(self.socket_path, 0o600)
+        # SIGTERM closes the server, which stops the peers cleanly below.
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.server.close)
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for username in list(self.peers):
+                self.stop_identity(username)
+            if self.socket_path.exists():
+                self.socket_path.unlink()
+
+
+# -------- Client ---------
+
+class DaemonError(Exception):
+    pass
+
+
+class DaemonClient:
+    """Blocking client for a running daemon."""
+
+    def __init__(self, socket_path: Path, timeout=CLIENT_TIMEOUT):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(str(socket_path))
+        self.reader = self.sock.makefile('rb')
+
+    @staticmethod
+    def connect(socket_path: Path):
+        """Return a client, or ``None`` when no daemon is listening."""
+        if not hasattr(socket, 'AF_UNIX') or not socket_path.exists():
+            return None
+        try:
+            return DaemonClient(socket_path)
+        except OSError:
+            return None
+
+    def call(self, user, method, /, **params):
+        request = {'user': user, 'method': method, 'params': params}
+        self.sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        line = self.reader.readline()
+        if not line:
+            raise DaemonError('Daemon closed the connection')
+        reply = json.loads(line)
+        if not reply['ok']:
+            raise DaemonError(reply['error'])
+        return reply['result']
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
@@ -0,0 +1,66 @@
+import heapq
+from itertools import islice
+
+# Posts fetched per followed timeline on each refresh.
+FEED_PAGE = 20
+# Posts kept in memory per followed user.
+FEED_MAX_PER_AUTHOR = 200
+
+
+class Feed:
+    """Home timeline merged from the users a peer follows.
+
+    Each followed timeline is kept locally, newest first. ``refresh`` only
+    asks the network for posts newer than the ones already held and
+    ``page`` k-way merges the timelines with a heap, so the merged feed is
+    never rebuilt from scratch.
+    """
+
+    def __init__(self, peer, page_size=FEED_PAGE, max_per_author=FEED_MAX_PER_AUTHOR):
+        self.peer = peer
+        self.page_size = page_size
+        self.max_per_author = max_per_author
+        self.timelines = {}
+
+    def following(self):
+        return list(self.peer.profile.following)
+
+    async def refresh(self):
+        """Fetch new posts of every followed user.
+
+        Yields each author's new posts (newest first) as soon as that
+        timeline arrives.
+        """
+        following = self.following()
+        for author in list(self.timelines):
+            if author not in following:
+                del self.timelines[author]
+        # Authors already held only need posts newer than their latest one,
+        # which usually costs just the head lookup. All of those are wanted,
+        # up to what is kept per author, or a burst would leave a gap.
+        since = {author: posts[0].timestamp for author, posts in self.timelines.items() if posts}
+        limit = {author: self.max_per_author if author in since else self.page_size
+                 for author in following}
+        async for author, posts in self.peer.fetch_posts_many(following, limit=limit, since=since):
+            new = self._merge(author, posts)
+            if new:
+                yield new
+
+    def _merge(self, author, posts):
+        held = self.timelines.setdefault(author, [])
+        ids = {p.id for p in held}
+        new = [p for p in reversed(posts) if p.id not in ids]
+        if new:
+            held[:0] = new
+            del held[self.max_per_author:]
+        return new
+
+    def page(self, limit=FEED_PAGE, before=None):
+        """Return up to ``limit`` merged posts, newest first.
+
+        ``before`` is a timestamp cursor: only older posts are returned.
+        """
+        merged = heapq.merge(*self.timelines.values(), key=lambda p: p.timestamp, reverse=True)
+        if before:
+            merged = (p for p in merged if p.timestamp < before)
+        return list(islice(merged, limit))
@@ -1,13 +1,15 @@
 import sys
 import os
 import json
+import queue
 import asyncio
 import tkinter as tk
+import tkinter.font as tkfont
 from tkinter import ttk, messagebox, filedialog
 from pathlib import Path
 from PIL import Image, ImageDraw
 import pystray
-from social_p2p import Peer, DEFAULT_PORT
+from social_p2p import Peer, DEFAULT_PORT, EventLoopThread
 
 TRANSLATIONS = {
     'en': {
@@ -23,6 +25,8 @@ TRANSLATIONS = {
         'Message:': 'Message:',
         'Send': 'Send',
         'Inbox:': 'Inbox:',
+        'Follow': 'Follow',
+        'Feed:': 'Feed:',
     },
     'es': {
         'Username:': 'Usuario:',
@@ -37,11 +41,213 @@ TRANSLATIONS = {
         'Message:': 'Mensaje:',
         'Send': 'Enviar',
         'Inbox:': 'Bandeja de entrada:',
+        'Follow': 'Seguir',
+        'Feed:': 'Novedades:',
     },
 }
 
 DEFAULT_DATA_DIR = Path.home() / '.p2psocial'
 CONFIG_FILE = 'config.json'
+# Fallback polling interval bounds in milliseconds. Peers push
+# notifications, so polling backs off while nothing changes.
+POLL_MIN_MS = 5000
+POLL_MAX_MS = 120000
+# Rows kept in memory per list; older rows are dropped and paged back in.
+SCROLLBACK = 500
+# Posts fetched per refresh and per page of older history.
+POST_PAGE = 50
+
+
+class Poller:
+    """Re-run ``tick`` on the Tk loop with exponential backoff.
+
+    ``tick(done)`` must call ``done(changed)`` when finished. ``poke`` runs
+    the next tick right away and resets the interval.
+    """
+
+    def __init__(self, widget, tick, minimum=POLL_MIN_MS, maximum=POLL_MAX_MS):
+        self.widget = widget
+        self.tick = tick
+        self.minimum = minimum
+        self.maximum = maximum
+        self.delay = minimum
+        self.job = None
+        self.busy = False
+        self.pending = False
+
+    def schedule(self, delay):
+        if self.job:
+            self.widget.after_cancel(self.job)
+        self.job = self.widget.after(delay, self.run)
+
+    def run(self):
+        self.job = None
+        self.busy = True
+        self.tick(self.done)
+
+    def done(self, changed):
+        self.busy = False
+        if changed or self.pending:
+            self.delay = self.minimum
+        else:
+            self.delay = min(self.delay * 2, self.maximum)
+        self.schedule(0 if self.pending else self.delay)
+        self.pending = False
+
+    def poke(self):
+        self.delay = self.minimum
+        if self.busy:
+            self.pending = True
+        else:
+            self.schedule(0)
+
+    def stop(self):
+        if self.job:
+            self.widget.after_cancel(self.job)
+            self.job = None
+
+
+class VirtualList(ttk.Frame):
+    """Scrollable list that only renders the rows in view.
+
+    Rows are ``(key, text)`` pairs kept in ``items``, at most ``capacity`` of
+    them. The Text widget only ever holds the visible window and updates
+    rewrite just the lines that differ. When the view gets within a screen
+    of the end, ``load_more(view, last_key)`` is asked for older rows, which
+    are handed back through ``view.extend``.
+    """
+
+    def __init__(self, master, height=24, capacity=SCROLLBACK, load_more=None, items=None):
+        super().__init__(master)
+        self.text = tk.Text(self, height=height, state='disabled', wrap='none')
+        self.text.grid(row=0, column=0, sticky='nsew')
+        self.scrollbar = ttk.Scrollbar(self, command=self.yview)
+        self.scrollbar.grid(row=0, column=1, sticky='ns')
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+        self.line_height = tkfont.Font(font=self.text['font']).metrics('linespace')
+        self.rows = height
+        self.capacity = capacity
+        self.load_more = load_more
+        self.loading = False
+        self.exhausted = False
+        self.items = list(items or [])
+        self.top = 0
+        self.shown = []
+        self.text.bind('<Configure>', self.on_resize)
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.text.bind(sequence, self.on_wheel)
+        self.render()
+
+    # -------- Model updates ---------
+    def _upsert(self, items):
+        """Update rows whose key is known; return the unknown ones."""
+        positions = {key: i for i, (key, _) in enumerate(self.items)}
+        new = []
+        changed = False
+        for key, text in items:
+            i = positions.get(key)
+            if i is None:
+                new.append((key, text))
+            elif self.items[i][1] != text:
+                self.items[i] = (key, text)
+                changed = True
+        return new, changed
+
+    def prepend(self, items):
+        """Merge ``items`` (first row first) at the top; the tail is trimmed."""
+        new, changed = self._upsert(items)
+        if new:
+            self.items[:0] = new
+            if self.top:
+                self.top += len(new)  # keep the rows in view where they are
+            if len(self.items) > self.capacity:
+                del self.items[self.capacity:]
+                self.exhausted = False
+        self.render()
+        return bool(new) or changed
+
+    def append(self, items):
+        """Add ``items`` at the bottom; the head is trimmed."""
+        new, changed = self._upsert(items)
+        at_end = self.top + self.rows >= len(self.items)
+        self.items.extend(new)
+        surplus = len(self.items) - self.capacity
+        if surplus > 0:
+            del self.items[:surplus]
+            self.top = max(0, self.top - surplus)
+        if at_end:
+            self.top = max(0, len(self.items) - self.rows)
+        self.render()
+        return bool(new) or changed
+
+    def extend(self, items):
+        """Add a page of older rows returned by ``load_more``."""
+        self.loading = False
+        new, _ = self._upsert(items)
+        room = max(0, self.capacity - len(self.items))
+        if not new or not room:
+            self.exhausted = True
+        self.items.extend(new[:room])
+        self.render()
+
+    def replace(self, items):
+        """Swap in a new list of rows, redrawing only what changed."""
+        self.items = list(items[:self.capacity])
+        self.exhausted = False
+        self.render()
+
+    # -------- View ---------
+    def render(self):
+        self.top = max(0, min(self.top, len(self.items) - self.rows))
+        lines = [text for _, text in self.items[self.top:self.top + self.rows]]
+        if lines != self.shown:
+            self.text.configure(state='normal')
+            for i, line in enumerate(lines):
+                if i >= len(self.shown):
+                    self.text.insert('end-1c', ('\n' if i else '') + line)
+                elif self.shown[i] != line:
+                    self.text.delete(f'{i + 1}.0', f'{i + 1}.end')
+                    self.text.insert(f'{i + 1}.0', line)
+            if len(lines) < len(self.shown):
+                self.text.delete(f'{len(lines)}.end' if lines else '1.0', 'end')
+            self.text.configure(state='disabled')
+            self.shown = lines
+        if self.items:
+            self.scrollbar.set(self.top / len(self.items),
+                               min(1.0, (self.top + self.rows) / len(self.items)))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+        self.maybe_load()
+
+    def maybe_load(self):
+        near_end = self.top + 2 * self.rows >= len(self.items)
+        if self.load_more and self.items and near_end and not (self.loading or self.exhausted):
+            self.loading = True
+            self.load_more(self, self.items[-1][0])
+
+    def yview(self, action, amount, unit=None):
+        if action == 'moveto':
+            self.top = int(float(amount) * len(self.items))
+        elif unit == 'pages':
+            self.top += int(amount) * self.rows
+        else:
+            self.top += int(amount)
+        self.render()
+
+    def on_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.yview('scroll', -3, 'units')
+        else:
+            self.yview('scroll', 3, 'units')
+        return 'break'
+
+    def on_resize(self, event):
+        inset = 2 * sum(int(self.text[option]) for option in ('borderwidth', 'highlightthickness', 'pady'))
+        rows = max(1, (event.height - inset) // self.line_height)
+        if rows != self.rows:
+            self.rows = rows
+            self.render()
 
 
 class App(tk.Tk):
@@ -60,6 +266,18 @@ class App(tk.Tk):
 
         self.peer = None
         self.tray = None
+        # All DHT work runs on one background loop for the life of the app;
+        # results come back to the Tk thread through ``self.results``.
+        self.loop = EventLoopThread()
+        self.results = queue.Queue()
+        self.events = queue.Queue()
+        self.message_poller = None
+        self.post_poller = None
+        self.feed_poller = None
+        self.post_list = None
+        self.inbox = None
+        self.feed_list = None
+        self.after(50, self.drain_results)
         self.protocol('WM_DELETE_WINDOW', self.on_close)
 
         self.config_data = {}
@@ -69,6 +287,30 @@ class App(tk.Tk):
         self.load_or_setup()
         self.build_menu()
 
+    def run_async(self, coro, callback=None, errback=None):
+        """Run ``coro`` on the peer loop and hand the outcome to the Tk thread."""
+        future = self.loop.submit(coro)
+        future.add_done_callback(lambda f: self.results.put((f, callback, errback)))
+
+    def drain_results(self):
+        while True:
+            try:
+                future, callback, errback = self.results.get_nowait()
+            except queue.Empty:
+                break
+            exc = future.exception()
+            if exc is not None:
+                if errback:
+                    errback(exc)
+            elif callback:
+                callback(future.result())
+        while True:
+            try:
+                self.events.get_nowait()()
+            except queue.Empty:
+                break
+        self.after(50, self.drain_results)
+
     def t(self, text: str) -> str:
         return TRANSLATIONS.get(self.lang, TRANSLATIONS['en']).get(text, text)
 
@@ -159,10 +401,11 @@ class App(tk.Tk):
         ttk.Label(frame, text=self.t('Search user:')).grid(row=0, column=0, sticky='w')
         ttk.Entry(frame, textvariable=self.search_var).grid(row=0, column=1, sticky='ew')
         ttk.Button(frame, text=self.t('Lookup'), command=self.lookup_user).grid(row=0, column=2, padx=5)
+        ttk.Button(frame, text=self.t('Follow'), command=self.follow_user).grid(row=0, column=3)
         frame.columnconfigure(1, weight=1)
 
         self.profile_text = tk.Text(frame, height=6, state='disabled')
-        self.profile_text.grid(row=1, column=0, columnspan=3, pady=5, sticky='nsew')
+        self.profile_text.grid(row=1, column=0, columnspan=4, pady=5, sticky='nsew')
         frame.rowconfigure(1, weight=1)
 
         ttk.Label(frame, text=self.t('New Post:')).grid(row=2, column=0, sticky='w')
@@ -171,8 +414,10 @@ class App(tk.Tk):
         ttk.Button(frame, text=self.t('Publish'), command=self.publish_post).grid(row=2, column=2, padx=5)
 
         ttk.Label(frame, text=self.t('Your Posts:')).grid(row=3, column=0, sticky='nw')
-        self.post_box = tk.Text(frame, height=5, state='disabled')
-        self.post_box.grid(row=3, column=1, columnspan=2, sticky='nsew')
+        # Rows survive rebuilding the frame, e.g. after a language change.
+        self.post_list = VirtualList(frame, height=5, load_more=self.load_older_posts,
+                                     items=self.post_list and self.post_list.items)
+        self.post_list.grid(row=3, column=1, columnspan=3, sticky='nsew')
         frame.rowconfigure(3, weight=1)
 
         ttk.Label(frame, text=self.t('Message:')).grid(row=4, column=0, sticky='w')
@@ -181,10 +426,16 @@ class App(tk.Tk):
         ttk.Button(frame, text=self.t('Send'), command=self.send_message).grid(row=4, column=2, padx=5)
 
         ttk.Label(frame, text=self.t('Inbox:')).grid(row=5, column=0, sticky='nw')
-        self.inbox = tk.Text(frame, state='disabled')
-        self.inbox.grid(row=5, column=1, columnspan=2, sticky='nsew')
+        self.inbox = VirtualList(frame, items=self.inbox and self.inbox.items)
+        self.inbox.grid(row=5, column=1, columnspan=3, sticky='nsew')
         frame.rowconfigure(5, weight=1)
 
+        ttk.Label(frame, text=self.t('Feed:')).grid(row=6, column=0, sticky='nw')
+        self.feed_list = VirtualList(frame, height=6, load_more=self.load_older_feed,
+                                     items=self.feed_list and self.feed_list.items)
+        self.feed_list.grid(row=6, column=1, columnspan=3, sticky='nsew')
+        frame.rowconfigure(6, weight=1)
+
     def start_peer(self, auto=False):
         username = self.username_var.get().strip()
         if not username:
@@ -194,87 +445,159 @@ class App(tk.Tk):
         bootstrap = self.bootstrap_var.get().strip() or None
         profile_path = self.data_dir / f"{username}_profile.json"
         self.peer = Peer(username, port=port, profile_path=profile_path)
-        try:
-            asyncio.run(self.peer.start(bootstrap))
-        except Exception as exc:
+
+        def started(_):
+            self.config_data['username'] = username
+            self.config_data['port'] = port
+            self.config_data['bootstrap'] = bootstrap or ''
+            self.config_data['data_dir'] = str(self.data_dir)
+            self.config_data['minimize_to_tray'] = self.minimize_to_tray
+            self.save_config()
+            if not auto:
+                self.connect_frame.destroy()
+            self.create_main_frame()
+            self.message_poller = Poller(self, self.check_messages)
+            self.post_poller = Poller(self, self.refresh_posts)
+            self.feed_poller = Poller(self, self.refresh_feed)
+            for poller in (self.message_poller, self.post_poller, self.feed_poller):
+                poller.schedule(0)
+            # Called on the peer loop; hop over to Tk through the queue.
+            self.peer.subscribe(lambda kind, user: self.events.put(lambda: self.poke(kind)))
+
+        def failed(exc):
             messagebox.showerror('Error', f'Could not start peer: {exc}')
-            return
-        self.config_data['username'] = username
-        self.config_data['port'] = port
-        self.config_data['bootstrap'] = bootstrap or ''
-        self.config_data['data_dir'] = str(self.data_dir)
-        self.config_data['minimize_to_tray'] = self.minimize_to_tray
-        self.save_config()
-        if not auto:
-            self.connect_frame.destroy()
-        self.create_main_frame()
-        self.after(5000, self.check_messages)
-        self.after(5000, self.refresh_posts)
+            if auto:
+                self.create_connect_frame()
 
-    def lookup_user(self):
+        self.run_async(self.peer.start(bootstrap), started, failed)
+
+    def poke(self, kind):
+        pollers = [self.message_poller] if kind == 'message' else [self.post_poller, self.feed_poller]
+        for poller in pollers:
+            if poller:
+                poller.poke()
+
+    def follow_user(self):
         user = self.search_var.get().strip()
         if not user:
             return
-        try:
-            profile, addr = asyncio.run(self.peer.lookup_user(user))
-        except Exception as exc:
-            messagebox.showerror('Error', str(exc))
-            return
+        self.run_async(self.peer.follow(user), lambda _: self.feed_poller.poke(),
+                       lambda exc: messagebox.showerror('Error', str(exc)))
+
+    def show_search(self, query, found, local):
+        users, matches = local
+        lines = []
+        if found is not None:
+            profile, addr = found
+            lines.append(f'Profile for {query}\n{profile}\nAddress: {addr}' if profile
+                         else 'User not found')
+        if users:
+            lines.append('Users: ' + ', '.join(users))
+        for kind, record in matches:
+            if kind == 'post':
+                lines.append(f'{record.timestamp} {record.author}: {record.text}')
+            else:
+                lines.append(f'@{record.username}: {record.about}')
         self.profile_text.configure(state='normal')
         self.profile_text.delete('1.0', 'end')
-        if profile:
-            self.profile_text.insert('end', f'Profile for {user}\n{profile}\nAddress: {addr}')
-        else:
-            self.profile_text.insert('end', 'User not found')
+        self.profile_text.insert('end', '\n'.join(lines))
         self.profile_text.configure(state='disabled')
 
+    def lookup_user(self):
+        query = self.search_var.get().strip()
+        if not query:
+            return
+
+        # Matches from the local search index show up at once; the exact
+        # DHT lookup of the query as a username follows.
+        async def search():
+            local = self.peer.search.users(query), self.peer.search.search(query)
+            self.events.put(lambda: self.show_search(query, None, local))
+            found = await self.peer.lookup_user(query)
+            self.events.put(lambda: self.show_search(query, found, local))
+
+        self.run_async(search(), errback=lambda exc: messagebox.showerror('Error', str(exc)))
+
     def send_message(self):
         msg = self.msg_var.get().strip()
         to_user = self.search_var.get().strip()
         if not msg or not to_user:
             return
-        try:
-            asyncio.run(self.peer.send_message(to_user, msg))
+
+        def sent(msg_id):
+            if not msg_id:
+                messagebox.showerror('Error', 'Message could not be stored, try again')
+                return
             messagebox.showinfo('Info', 'Message queued')
             self.msg_var.set('')
-        except Exception as exc:
-            messagebox.showerror('Error', str(exc))
+
+        self.run_async(self.peer.send_message(to_user, msg), sent,
+                       lambda exc: messagebox.showerror('Error', str(exc)))
 
     def publish_post(self):
         text = self.post_var.get().strip()
         if not text:
             return
-        try:
-            asyncio.run(self.peer.add_post(text))
+
+        def published(post):
+            if not post:
+                messagebox.showerror('Error', 'Post could not be stored, try again')
+                return
             self.post_var.set('')
-            self.refresh_posts()
-        except Exception as exc:
-            messagebox.showerror('Error', str(exc))
 
-    def check_messages(self):
-        try:
-            msgs = asyncio.run(self.peer.fetch_messages())
+        self.run_async(self.peer.add_post(text), published,
+                       lambda exc: messagebox.showerror('Error', str(exc)))
+
+    def check_messages(self, done):
+        def show(msgs):
             if msgs:
-                self.inbox.configure(state='normal')
-                for m in msgs:
-                    self.inbox.insert('end', f"From {m['from']}: {m['msg']}\n")
-                self.inbox.configure(state='disabled')
-                self.inbox.see('end')
-        except Exception:
-            pass
-        self.after(5000, self.check_messages)
-
-    def refresh_posts(self):
-        try:
-            posts = asyncio.run(self.peer.fetch_posts(self.peer.username))
-            self.post_box.configure(state='normal')
-            self.post_box.delete('1.0', 'end')
-            for p in posts:
-                self.post_box.insert('end', f"{p.timestamp}: {p.text} ({p.likes} likes)\n")
-            self.post_box.configure(state='disabled')
-        except Exception:
-            pass
-        self.after(5000, self.refresh_posts)
+                # Messages from older versions have no id.
+                self.inbox.append([(m.get('id') or (m['from'], m.get('ts')),
+                                    f"From {m['from']}: {m['msg']}") for m in msgs])
+            done(bool(msgs))
+
+        self.run_async(self.peer.fetch_messages(), show, lambda exc: done(False))
+
+    @staticmethod
+    def post_row(p, author=False):
+        who = f' {p.author}' if author else ''
+        return (p.timestamp, p.id), f"{p.timestamp}{who}: {p.text} ({p.likes} likes)"
+
+    def refresh_posts(self, done):
+        # Only the newest page is fetched; rows already shown are updated in
+        # place and older history is paged in as the list is scrolled.
+        def show(posts):
+            done(self.post_list.prepend([self.post_row(p) for p in reversed(posts)]))
+
+        self.run_async(self.peer.fetch_posts(self.peer.username, limit=POST_PAGE), show,
+                       lambda exc: done(False))
+
+    def load_older_posts(self, post_list, last_key):
+        self.run_async(self.peer.fetch_posts(self.peer.username, limit=POST_PAGE, before=last_key[0]),
+                       lambda posts: post_list.extend([self.post_row(p) for p in reversed(posts)]),
+                       lambda exc: post_list.extend([]))
+
+    def show_feed(self):
+        rows = max(len(self.feed_list.items), POST_PAGE)
+        self.feed_list.replace([self.post_row(p, author=True) for p in self.peer.feed.page(rows)])
+
+    def load_older_feed(self, feed_list, last_key):
+        # The feed is merged from timelines already held in memory.
+        feed_list.extend([self.post_row(p, author=True)
+                          for p in self.peer.feed.page(POST_PAGE, before=last_key[0])])
+
+    async def stream_feed(self):
+        changed = False
+        async for _ in self.peer.feed.refresh():
+            changed = True
+            self.events.put(self.show_feed)
+        # Renew push subscriptions so followed users keep poking us.
+        await asyncio.gather(*(self.peer.watch(u) for u in self.peer.feed.following()),
+                             return_exceptions=True)
+        return changed
+
+    def refresh_feed(self, done):
+        self.run_async(self.stream_feed(), done, lambda exc: done(False))
 
     # ------------- System tray handling -------------
     def create_tray_icon(self):
@@ -308,6 +631,12 @@ class App(tk.Tk):
         if self.tray:
             self.tray.stop()
             self.tray = None
+        for poller in (self.message_poller, self.post_poller, self.feed_poller):
+            if poller:
+                poller.stop()
+        if self.peer:
+            self.loop.call(self.peer.stop)
+        self.loop.stop()
         self.destroy()
 
 
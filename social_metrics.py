@@ -0,0 +1,99 @@
+import time
+from dataclasses import dataclass
+
+# Upper bounds (seconds) of the latency histogram buckets.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+@dataclass
+class Operation:
+    """What happened during one ``Peer`` DHT operation."""
+    name: str
+    started: float = 0.0
+    duration: float = 0.0
+    ok: bool = True
+    found: bool = True
+    bytes_read: int = 0
+    bytes_written: int = 0
+    retries: int = 0
+
+
+class Hooks:
+    """Interface for observing ``Peer`` operations.
+
+    Pass an instance as ``Peer(hooks=...)``. Peers without hooks skip all
+    bookkeeping.
+    """
+
+    def record(self, op: Operation):
+        pass
+
+
+class Metrics(Hooks):
+    """Hooks that aggregate operations into counters and histograms."""
+
+    def __init__(self):
+        self.ops = {}
+        self.started = time.time()
+
+    def _entry(self, name):
+        entry = self.ops.get(name)
+        if entry is None:
+            entry = self.ops[name] = {
+                'count': 0, 'errors': 0, 'misses': 0, 'retries': 0,
+                'bytes_read': 0, 'bytes_written': 0, 'duration': 0.0,
+                'buckets': [0] * len(DURATION_BUCKETS),
+            }
+        return entry
+
+    def record(self, op: Operation):
+        entry = self._entry(op.name)
+        entry['count'] += 1
+        entry['errors'] += not op.ok
+        entry['misses'] += op.ok and not op.found
+        entry['retries'] += op.retries
+        entry['bytes_read'] += op.bytes_read
+        entry['bytes_written'] += op.bytes_written
+        entry['duration'] += op.duration
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if op.duration <= bound:
+                entry['buckets'][i] += 1
+                break
+
+    def snapshot(self):
+        return {name: {k: v for k, v in entry.items() if k != 'buckets'}
+                for name, entry in sorted(self.ops.items())}
+
+    def render_prometheus(self, cache_stats=None):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        counters = (
+            ('p2p_operations_total', 'count', 'DHT operations performed'),
+            ('p2p_operation_errors_total', 'errors', 'Operations that raised'),
+            ('p2p_operation_misses_total', 'misses', 'Operations that found nothing'),
+            ('p2p_operation_retries_total', 'retries', 'Retried DHT writes'),
+            ('p2p_operation_bytes_read_total', 'bytes_read', 'Value bytes read'),
+            ('p2p_operation_bytes_written_total', 'bytes_written', 'Value bytes written'),
+        )
+        for metric, field, help_text in counters:
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} counter')
+            for name, entry in sorted(self.ops.items()):
+                lines.append(f'{metric}{{op="{name}"}} {entry[field]}')
+        metric = 'p2p_operation_duration_seconds'
+        lines.append(f'# HELP {metric} Time spent in DHT operations')
+        lines.append(f'# TYPE {metric} histogram')
+        for name, entry in sorted(self.ops.items()):
+            cumulative = 0
+            for bound, hits in zip(DURATION_BUCKETS, entry['buckets']):
+                cumulative += hits
+                lines.append(f'{metric}_bucket{{op="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{op="{name}",le="+Inf"}} {entry["count"]}')
+            lines.append(f'{metric}_sum{{op="{name}"}} {entry["duration"]:.6f}')
+            lines.append(f'{metric}_count{{op="{name}"}} {entry["count"]}')
+        if cache_stats is not None:
+            for field in ('hits', 'misses'):
+                metric = f'p2p_cache_{field}_total'
+                lines.append(f'# TYPE {metric} counter')
+                lines.append(f'{metric} {cache_stats[field]}')
+        return '\n'.join(lines) + '\n'
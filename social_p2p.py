@@ -1,11 +1,96 @@
 import asyncio
+import contextvars
+import functools
+import hashlib
 import json
-from dataclasses import dataclass, asdict, field
-from datetime import datetime
+import os
+import random
+import socket
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass, asdict, field, fields, replace
+from datetime import datetime, timedelta
 from pathlib import Path
+from kademlia.crawling import NodeSpiderCrawl, ValueSpiderCrawl
 from kademlia.network import Server
+from kademlia.node import Node
+from kademlia.protocol import KademliaProtocol
+from kademlia.utils import digest as dht_digest
+import umsgpack
+from social_cache import Cache
+import social_codec as codec
+from social_metrics import Metrics, Operation
+from social_feed import Feed
+from social_storage import SQLiteStorage
+from social_blobs import BlobStore, is_blob_ref
+from social_search import SearchIndex
+from social_signing import Signer, KeyRing, Verifier
 
 DEFAULT_PORT = 8468
+DEFAULT_DATA_DIR = Path.home() / '.p2psocial'
+# Number of posts stored in each ``posts:<user>:<n>`` chunk. Small enough
+# that a full chunk still fits in a single Kademlia UDP datagram.
+POSTS_PER_CHUNK = 20
+# Read inbox messages are dropped and acknowledged once this many have piled
+# up; senders prune their lists past the acknowledgement when this long.
+INBOX_PRUNE_THRESHOLD = 50
+# Entries a sender keeps in one ``inbox:<to>:<from>`` list, so it still fits
+# in a datagram; the oldest unread ones are dropped beyond this.
+OUTBOX_MAX = 64
+# How often a sender re-checks that the ``senders:<user>`` directory lists it.
+INBOX_WRITE_RETRIES = 5
+# Seconds after which a sender's list is read again even without a poke.
+INBOX_RECHECK = 300
+# Senders silent this long, with nothing left to read or drop, are forgotten
+# and left out of the ``senders:<user>`` directory.
+INBOX_SENDER_IDLE = 30 * 86400
+# Upper bound on DHT lookups in flight for one batch call.
+BATCH_CONCURRENCY = 16
+# How often a liker re-checks that a chunk's ``likers:`` directory lists it.
+LIKE_WRITE_RETRIES = 5
+# Authors whose timelines are kept decoded in memory by ``PostIndex``.
+MAX_INDEXED_AUTHORS = 256
+# Profile fields that hold ``blob:<hash>`` references to media in the blob
+# store instead of inline data.
+MEDIA_FIELDS = ('avatar', 'wallpaper', 'resume')
+# Profile edits are coalesced for this many seconds before being written.
+PROFILE_DEBOUNCE = 2.0
+# Seconds a peer keeps pushing post notifications to a watcher that has not
+# renewed its watch.
+WATCH_TTL = 300
+# Known-good contacts kept in the routing table snapshot.
+CONTACTS_MAX = 32
+# Seconds between routing table snapshots while running.
+CONTACTS_SAVE_INTERVAL = 300
+# Startup crawls as soon as this many snapshot contacts answered a ping.
+BOOTSTRAP_QUORUM = 3
+# Seconds between runs of the timeline and inbox maintenance task.
+MAINTENANCE_INTERVAL = 3600
+# Posts a timeline may hold; heads claiming more are taken as malformed.
+MAX_TIMELINE_POSTS = 100_000
+# Posts published before our signing key existed are signed for this many
+# seconds after it was created; copies still unsigned then are given up.
+SIGNING_WINDOW = 7 * 86400
+# Written over records dropped by retention. Readers treat it as missing and
+# it is never republished, so it expires from the network.
+TOMBSTONE = b''
+# Hosted values older than this are republished, as in kademlia.
+REPUBLISH_AGE = 3600
+# Raised when decoding, or using, a malformed record. Such records are
+# treated like forged ones: dropped as if they were not there.
+DECODE_ERRORS = (ValueError, TypeError, KeyError, zlib.error, umsgpack.UnpackException)
+# Timeline head fields and their types.
+HEAD_FIELDS = {'count': int, 'chunk_size': int, 'first': int, 'archived': int, 'latest': str}
+
+
+def _checked(record):
+    """Return dataclass ``record`` if every field has its declared type."""
+    for f in fields(record):
+        if not isinstance(getattr(record, f.name), f.type):
+            raise ValueError(f'Malformed {type(record).__name__} field {f.name}')
+    return record
 
 @dataclass
 class Profile:
@@ -24,6 +109,11 @@ class Profile:
     location: str = ''
     birthday: str = ''
     visibility: dict = field(default_factory=dict)
+    following: list = field(default_factory=list)
+    # Public signing key; records of this user must verify against it.
+    key: str = ''
+    # Raised on every edit; readers ignore profiles older than one seen.
+    version: int = 0
 
     def to_json(self):
         return json.dumps(asdict(self))
@@ -33,6 +123,14 @@ class Profile:
         info = json.loads(data)
         return Profile(**info)
 
+    def to_record(self):
+        """Compact binary form stored in the DHT."""
+        return codec.encode('profile', asdict(self))
+
+    @staticmethod
+    def from_record(data):
+        return _checked(Profile(**codec.decode(data)))
+
     @staticmethod
     def load(path: Path):
         if path.exists():
@@ -41,9 +139,15 @@ class Profile:
         return None
 
     def save(self, path: Path):
+        # Write to a temporary file and rename it over the old one so a crash
+        # never leaves a half-written profile behind.
         path.parent.mkdir(parents=True, exist_ok=True)
-        with open(path, 'w', encoding='utf-8') as f:
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
             f.write(self.to_json())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
 
 
 @dataclass
@@ -52,177 +156,1969 @@ class Post:
     text: str
     timestamp: str
     likes: int = 0
+    id: str = ''
+    # Author's signature over post_payload(); likes are not covered.
+    sig: str = ''
+
+    def __post_init__(self):
+        # Older records have no id; derive the same one add_post would.
+        if not self.id:
+            self.id = make_post_id(self.author, self.timestamp, self.text)
 
     def to_dict(self):
         return asdict(self)
 
     @staticmethod
     def from_dict(data: dict):
-        return Post(**data)
+        return _checked(Post(**data))
+
+    def payload(self):
+        return post_payload(self.author, self.timestamp, self.text)
+
+
+def post_payload(author: str, timestamp: str, text: str):
+    return f'{author}\n{timestamp}\n{text}'.encode('utf-8')
+
+
+def make_post_id(author: str, timestamp: str, text: str):
+    return hashlib.sha256(post_payload(author, timestamp, text)).hexdigest()[:16]
+
+
+@dataclass
+class Retention:
+    """How much of our own timeline and inbox the maintenance task keeps.
+
+    ``None`` keeps everything. Ages are in seconds. Posts are dropped in
+    whole chunks, so slightly more than ``max_posts`` may survive. Full
+    chunks beyond the newest ``live_chunks`` are archived: their likes are
+    folded into the posts and they can no longer be liked.
+    """
+    max_posts: int | None = None
+    max_post_age: float | None = None
+    max_messages: int | None = None
+    max_message_age: float | None = None
+    live_chunks: int = 5
+
+
+class PostIndex:
+    """Decoded posts of one author's timeline, addressable by id.
+
+    Chunks are kept per index together with the version (number of posts)
+    they were decoded at, so unchanged chunks are never parsed twice.
+    ``ids`` maps post id to ``(chunk, offset)``.
+    """
+
+    def __init__(self):
+        self.chunks = {}
+        self.ids = {}
+
+    def chunk(self, index, version):
+        entry = self.chunks.get(index)
+        if entry and entry[0] == version:
+            return entry[1]
+        return None
+
+    def add_chunk(self, index, version, posts):
+        self.chunks[index] = (version, posts)
+        for offset, post in enumerate(posts):
+            self.ids[post.id] = (index, offset)
+
+    def get(self, post_id):
+        """Return ``(chunk, offset)`` of ``post_id`` or ``None``."""
+        return self.ids.get(post_id)
+
+    def discard_before(self, first):
+        """Forget chunks below ``first``, which retention has dropped."""
+        stale = [index for index in self.chunks if index < first]
+        if not stale:
+            return
+        for index in stale:
+            del self.chunks[index]
+        self.ids = {post_id: loc for post_id, loc in self.ids.items() if loc[0] >= first}
+
+
+codec.register_dataclass('profile', 1, Profile)
+codec.register_dataclass('post', 2, Post)
+codec.register('message', 3, ('from', 'msg', 'ts', 'nonce', 'to'))
+# Envelope around another encoded record and its author's signature.
+codec.register('signed', 4, ('data', 'sig'))
+# A grow-only set of names, united rather than replaced wherever it is stored.
+codec.register('names', 5, ('names',))
+
+
+def seal(signer, data: bytes):
+    return codec.encode('signed', {'data': data, 'sig': signer.sign(data)})
+
+
+def unseal(value):
+    """Return ``(data, sig)``; unsigned values come back with ``sig=None``."""
+    if codec.kind_of(value) == 'signed':
+        envelope = codec.decode(value)
+        data, sig = envelope['data'], envelope['sig']
+        if not isinstance(data, bytes) or not isinstance(sig, str):
+            raise ValueError('Malformed signed record')
+        return data, sig
+    return value, None
+
+
+# -------- Record decoding ---------
+# Anyone can write any key, so every value read from the DHT is decoded by
+# one of these. They raise one of DECODE_ERRORS for anything malformed.
+
+def decode_posts(data):
+    """The posts of an encoded chunk or legacy post list."""
+    return [Post.from_dict(p) for p in codec.decode(data)]
+
+
+def decode_head(data):
+    """``(head, legacy)`` of an encoded timeline head, as ``Peer._get_head`` returns them."""
+    head = codec.decode(data)
+    if isinstance(head, list):
+        for p in head:
+            Post.from_dict(p)  # checks it
+        return {'count': len(head), 'chunk_size': POSTS_PER_CHUNK}, head
+    if not isinstance(head, dict):
+        raise ValueError('Malformed timeline head')
+    for name, kind in HEAD_FIELDS.items():
+        if name in head and not isinstance(head[name], kind):
+            raise ValueError(f'Malformed timeline head field {name}')
+    size = head.get('chunk_size', POSTS_PER_CHUNK)
+    count = head.get('count', 0)
+    chunks = -(-count // size) if size > 0 else 0
+    if not (1 <= size <= POSTS_PER_CHUNK and 0 <= count <= MAX_TIMELINE_POSTS
+            and all(0 <= head.get(name, 0) <= chunks for name in ('first', 'archived'))):
+        raise ValueError('Malformed timeline head')
+    return head, None
+
+
+def open_head(value):
+    """``(head, legacy, data, sig)`` of a stored timeline head."""
+    data, sig = unseal(value)
+    return (*decode_head(data), data, sig)
+
+
+def open_message(body):
+    """``(record, data, sig)`` of a stored message."""
+    data, sig = unseal(body)
+    record = codec.decode(data)
+    if not isinstance(record, dict) or not all(
+            isinstance(record.get(name), str) for name in ('from', 'msg', 'ts')):
+        raise ValueError('Malformed message')
+    return record, data, sig
+
+
+def decode_inbox(data):
+    """An ``{'seq', 'entries'}`` inbox list, leaving out malformed entries."""
+    inbox = codec.decode(data)
+    if not isinstance(inbox, dict) or not isinstance(inbox.get('seq'), int):
+        raise ValueError('Malformed inbox list')
+    entries = inbox.get('entries')
+    return {'seq': inbox['seq'], 'entries': [
+        e for e in entries if isinstance(e, list) and 2 <= len(e) <= 3
+        and isinstance(e[0], int) and all(isinstance(x, str) for x in e[1:])]}
+
+
+def decode_names(data):
+    """The names of an encoded ``names`` set."""
+    if codec.kind_of(data) != 'names':
+        raise ValueError('Not a names set')
+    return [name for name in codec.decode(data)['names'] if isinstance(name, str)]
+
+
+def decode_likes(data):
+    """The ``post -> count`` items of an encoded like record."""
+    record = codec.decode(data)
+    if not isinstance(record, dict):
+        raise ValueError('Malformed like record')
+    return {post: count for post, count in record.items()
+            if isinstance(post, str) and isinstance(count, int) and count > 0}
+
+
+def check_address(value):
+    """Return a published ``host:port`` address if it is one."""
+    _, port = value.rsplit(':', 1)
+    int(port)
+    return value
+
+
+def merge_names(stored, value):
+    """The value to store when ``value`` arrives for a key holding ``stored``.
+
+    Two ``names`` sets are united, so names added concurrently by different
+    writers all survive. Anything else, tombstones included, replaces the
+    stored value.
+    """
+    if codec.kind_of(value) != 'names' or codec.kind_of(stored) != 'names':
+        return value
+    try:
+        names = codec.decode(stored)['names']
+        extra = [name for name in codec.decode(value)['names'] if name not in names]
+        return codec.encode('names', {'names': names + extra}) if extra else stored
+    except DECODE_ERRORS:
+        return value
+
+# The operation being recorded for hooks in the current task, if any.
+_current_op = contextvars.ContextVar('current_op', default=None)
+
+
+def _value_size(value):
+    if value is None:
+        return 0
+    return len(value.encode('utf-8')) if isinstance(value, str) else len(value)
+
+
+def instrumented(found=None):
+    """Report a ``Peer`` coroutine method to ``peer.hooks``.
+
+    ``found(result)``, when given, decides whether the call counts as a hit
+    or a miss. Peers without hooks call straight through.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            if self.hooks is None:
+                return await func(self, *args, **kwargs)
+            op = Operation(func.__name__, started=time.perf_counter())
+            token = _current_op.set(op)
+            try:
+                result = await func(self, *args, **kwargs)
+                op.found = found is None or bool(found(result))
+                return result
+            except Exception:
+                op.ok = False
+                raise
+            finally:
+                _current_op.reset(token)
+                op.duration = time.perf_counter() - op.started
+                self.hooks.record(op)
+        return wrapper
+    return decorate
+
+
+class EventLoopThread:
+    """Run an asyncio event loop in a background thread.
+
+    Lets synchronous front ends keep one long-lived loop (and the Kademlia
+    UDP transport bound to it) instead of calling ``asyncio.run`` per action.
+    """
+
+    def __init__(self, name='p2p-loop'):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """Schedule ``coro`` on the loop and return a ``concurrent.futures.Future``."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, func, *args):
+        """Run a plain callable on the loop thread."""
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def stop(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=5)
+
+
+class SocialProtocol(KademliaProtocol):
+    """Kademlia protocol extended with direct peer notifications.
+
+    ``notify`` pokes a peer when something it cares about changed and
+    ``watch`` asks a peer to send ``post`` notifications back to us. Stores
+    of ``names`` sets are merged with the copy held here.
+    """
+
+    peer = None
+
+    def rpc_notify(self, sender, kind, username):
+        if self.peer:
+            self.peer._notified(kind, username)
+        return True
+
+    def rpc_store(self, sender, nodeid, key, value):
+        return super().rpc_store(sender, nodeid, key, merge_names(self.storage.get(key), value))
+
+    def rpc_watch(self, sender):
+        if self.peer:
+            self.peer.watchers[tuple(sender)] = time.monotonic() + WATCH_TTL
+        return True
+
+    def welcome_if_new(self, node):
+        new = self.router.is_new_node(node)
+        super().welcome_if_new(node)
+        # A profile that reached nobody (we started alone) is published once
+        # someone joins: readers need the key in it to accept our records.
+        # A loopback address is republished once a node on another host joins.
+        if new and self.peer and (self.peer.profile_unpublished
+                                  or not self.peer._published_host(node.ip)):
+            self.peer._spawn(self.peer.publish_profile())
+        # Likewise for the posts written before we had a key.
+        if new and self.peer and self.peer.unsigned is not None and 'ids' not in self.peer.unsigned:
+            self.peer._spawn(self.peer.sign_timeline())
+
+
+class NamesSpiderCrawl(ValueSpiderCrawl):
+    """Value lookup that unites differing ``names`` sets instead of voting."""
+
+    async def _handle_found_values(self, values):
+        value = await super()._handle_found_values(values)
+        if codec.kind_of(value) != 'names':
+            return value
+        sets = [v for v in values if codec.kind_of(v) == 'names']
+        return functools.reduce(merge_names, sets, value)
+
+
+class SocialServer(Server):
+    protocol_class = SocialProtocol
+
+    async def get(self, key):
+        # A replica of a names set may have missed an addition (a store that
+        # timed out), so those are also read from the network and united
+        # with our copy; anything else is served locally when we have it.
+        dkey = dht_digest(key)
+        local = self.storage.get(dkey)
+        if local is not None and codec.kind_of(local) != 'names':
+            return local
+        node = Node(dkey)
+        nearest = self.protocol.router.find_neighbors(node)
+        if not nearest:
+            return local
+        found = await NamesSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha).find()
+        return local if found is None else merge_names(local, found)
+
+    async def set_digest(self, dkey, value):
+        # Kademlia's set_digest, except that a names set is merged into our
+        # own copy when that is written, after the lookup, so additions
+        # stored here meanwhile are kept; the union is sent on. A copy we
+        # hold is rewritten even if we are not among the closest: get
+        # reads it first.
+        node = Node(dkey)
+        nearest = self.protocol.router.find_neighbors(node)
+        if not nearest:
+            return False
+        nodes = await NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha).find()
+        closest = self.node.distance_to(node) < max(n.distance_to(node) for n in nodes)
+        if closest or self.storage.get(dkey) is not None:
+            value = merge_names(self.storage.get(dkey), value)
+            self.storage[dkey] = value
+        return any(await asyncio.gather(*(self.protocol.call_store(n, dkey, value) for n in nodes)))
+
+    async def _refresh_table(self):
+        # Kademlia's refresh, except that tombstones are not republished.
+        await asyncio.gather(*(
+            NodeSpiderCrawl(self.protocol, node, self.protocol.router.find_neighbors(node, self.alpha),
+                            self.ksize, self.alpha).find()
+            for node in map(Node, self.protocol.get_refresh_ids())))
+        for dkey, value in self.storage.iter_older_than(REPUBLISH_AGE):
+            if value != TOMBSTONE:
+                await self.set_digest(dkey, value)
+
 
 class Peer:
-    def __init__(self, username, port=DEFAULT_PORT, profile_path: Path | None = None):
+    def __init__(self, username, port=DEFAULT_PORT, profile_path: Path | None = None,
+                 hooks=None, retention: Retention | None = None, data_dir: Path | None = None):
         self.username = username
+        self.hooks = hooks
+        self.retention = retention or Retention()
         self.port = port
-        self.server = Server()
         self.profile_path = profile_path
+        # With a data dir, values this node hosts for the network survive
+        # restarts; otherwise kademlia's in-memory storage is used.
+        self.storage = (SQLiteStorage(profile_path.with_name(f'{username}_dht.sqlite3'))
+                        if profile_path else None)
+        self.server = SocialServer(storage=self.storage)
+        self.cache = Cache(path=profile_path.with_name(f'{username}_cache.json')
+                           if profile_path else None)
+        self.cache.load()
         loaded = Profile.load(profile_path) if profile_path else None
-        if loaded:
-            self.profile = loaded
-        else:
-            self.profile = Profile(username=username, visibility={})
-            if profile_path:
-                self.profile.save(profile_path)
+        self.profile = loaded or Profile(username=username, visibility={})
+        # Profile persistence is tracked by content hash so unchanged
+        # profiles are never rewritten; a new profile is first saved on start.
+        self.dirty_fields = set()
+        self._saved_hash = self._content_hash(self.profile.to_json()) if loaded else None
+        # Profiles, posts and messages we write are signed; records of other
+        # users are checked against the key pinned from their profile. Peers
+        # pin our key on first sight, so it is kept on disk even without a
+        # profile directory: in ``data_dir``, by default ~/.p2psocial.
+        data_dir = profile_path.parent if profile_path else data_dir or DEFAULT_DATA_DIR
+        key_path = data_dir / f'{username}_signing.key'
+        self.signer = Signer(key_path)
+        self.profile.key = self.signer.public_key
+        # Present until the posts we wrote before the key existed are signed;
+        # see sign_timeline.
+        self.unsigned_marker = key_path.with_name(f'{username}_unsigned_posts')
+        if self.signer.created:
+            self._save_unsigned({'until': time.time() + SIGNING_WINDOW})
+        self.unsigned = self._load_unsigned()
+        self.keyring = KeyRing(profile_path.with_name(f'{username}_keys.json')
+                               if profile_path else None)
+        self.keyring.keys[username] = self.signer.public_key
+        self.verifier = Verifier(profile_path.with_name(f'{username}_verified.bin')
+                                 if profile_path else None)
+        self.verifier.load()
+        self._published = (None, None)
+        self.profile_unpublished = False
+        self._flush_handle = None
         self.post_key = f'posts:{self.username}'
+        self.inbox_key = f'inbox:{self.username}'
+        self.cursor_path = (profile_path.with_name(f'{username}_inbox.json')
+                            if profile_path else None)
+        self.inbox_cursor = self._load_cursor()
+        self._legacy_inbox_checked = False
+        # Senders that poked us since their list was last read.
+        self.inbox_senders = set()
+        # Each sender's list as last read, and when it was read.
+        self.inbox_held = {}
+        self.inbox_checked = {}
+        # Our own inbox:<to>:<us> lists, which only we write.
+        self.outboxes = {}
+        self._outbox_locks = {}
+        self.contacts_path = (profile_path.with_name(f'{username}_contacts.json')
+                              if profile_path else None)
+        self.contact_rtt = {}
+        self._contacts_handle = None
+        self.startup = {}
+        self._maintenance_handle = None
+        # Serialises writes to our own timeline head.
+        self._timeline_lock = asyncio.Lock()
+        # The head we last wrote, with the count it reached.
+        self.own_head = None
+        self.listeners = []
+        self.watchers = {}
+        self._tasks = set()
+        # Our own like records by key, as last written; counts only grow.
+        self.my_likes = {}
+        self._like_lock = asyncio.Lock()
+        self.post_indexes = OrderedDict()
+        self.feed = Feed(self)
+        self.blobs = BlobStore(self._get, self._set,
+                               profile_path.parent / 'blobs' if profile_path else None)
+        self.search = SearchIndex()
+        self._seed_search()
 
     async def start(self, bootstrap_node=None):
         await self.server.listen(self.port)
-        if bootstrap_node:
-            ip, port = bootstrap_node.split(':')
-            await self.server.bootstrap([(ip, int(port))])
+        if not self.port:
+            # Port 0 lets the OS pick a free port; advertise the real one.
+            self.port = self.server.transport.get_extra_info('sockname')[1]
+        self.server.protocol.peer = self
+        await self.bootstrap(bootstrap_node)
+        self._schedule_contacts_save()
+        self._schedule_maintenance()
+        # Without a saved profile our version restarts at 0; continue from
+        # the published one so readers do not take ours for a stale copy.
+        published = await self._get_profile(self.username)
+        if published and published.version > self.profile.version:
+            self.profile.version = published.version
+        self.search.add_profile(self.profile)
         # Store our IP and profile in the DHT
-        await self.publish_profile()
+        await self.publish_profile(force=True)
+        await self.sign_timeline()
+
+    def stop(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._contacts_handle:
+            self._contacts_handle.cancel()
+            self._contacts_handle = None
+        if self._maintenance_handle:
+            self._maintenance_handle.cancel()
+            self._maintenance_handle = None
+        if self.dirty_fields:
+            self.save_profile()
+        self.save_contacts()
+        self.server.stop()
+        self.cache.save()
+        self.verifier.save()
+        if self.storage:
+            self.storage.close()
+
+    # -------- Bootstrap ---------
+    # Contacts from the routing table are saved to ``<user>_contacts.json``
+    # on shutdown and every CONTACTS_SAVE_INTERVAL seconds, fastest first.
+    # Startup pings all of them at once and crawls from the first few to
+    # answer; the configured node is only tried when none of them does.
+
+    def _load_contacts(self):
+        if not self.contacts_path or not self.contacts_path.exists():
+            return []
+        try:
+            with open(self.contacts_path, 'r', encoding='utf-8') as f:
+                contacts = [(c['ip'], c['port']) for c in json.load(f)['contacts']]
+        except (OSError, ValueError, KeyError, TypeError):
+            return []
+        return [c for c in contacts
+                if not (c[1] == self.port and c[0] in ('127.0.0.1', 'localhost'))]
+
+    def save_contacts(self):
+        if not self.contacts_path or self.server.protocol is None:
+            return
+        nodes = [n for bucket in self.server.protocol.router.buckets for n in bucket.get_nodes()]
+        if not nodes:
+            return  # keep the last good snapshot rather than an empty one
+        nodes.sort(key=lambda n: self.contact_rtt.get((n.ip, n.port), float('inf')))
+        contacts = [{'ip': n.ip, 'port': n.port, 'rtt': self.contact_rtt.get((n.ip, n.port))}
+                    for n in nodes[:CONTACTS_MAX]]
+        self.contacts_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.contacts_path.with_name(self.contacts_path.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'saved': time.time(), 'contacts': contacts}, f)
+        os.replace(tmp, self.contacts_path)
+
+    def _schedule_contacts_save(self):
+        def save():
+            self.save_contacts()
+            self._schedule_contacts_save()
+
+        self._contacts_handle = asyncio.get_running_loop().call_later(
+            CONTACTS_SAVE_INTERVAL, save)
+
+    async def _ping(self, addr):
+        started = time.monotonic()
+        node = await self.server.bootstrap_node(addr)
+        if node:
+            self.contact_rtt[addr] = time.monotonic() - started
+        return node
+
+    def _welcome_late(self, future):
+        if self.server.transport.is_closing():
+            return
+        if not future.cancelled() and not future.exception() and future.result():
+            self.server.protocol.welcome_if_new(future.result())
+
+    async def _crawl_from(self, addrs, quorum=BOOTSTRAP_QUORUM):
+        """Crawl from the first ``quorum`` of ``addrs`` to answer a ping."""
+        pings = [asyncio.ensure_future(self._ping(addr)) for addr in addrs]
+        nodes = []
+        for pinged in asyncio.as_completed(pings):
+            node = await pinged
+            if node:
+                nodes.append(node)
+                if len(nodes) >= quorum:
+                    break
+        # Slower contacts still join the routing table when they answer.
+        for ping in pings:
+            if not ping.done():
+                ping.add_done_callback(self._welcome_late)
+        if not nodes:
+            return []
+        server = self.server
+        spider = NodeSpiderCrawl(server.protocol, server.node, nodes, server.ksize, server.alpha)
+        return await spider.find()
+
+    @instrumented(found=bool)
+    async def bootstrap(self, bootstrap_node=None):
+        """Join the network; returns where the contacts came from, if anywhere.
+
+        ``self.startup`` records the source and the seconds it took until a
+        node lookup first succeeded.
+        """
+        started = time.monotonic()
+        contacts = self._load_contacts()
+        source = None
+        if contacts and await self._crawl_from(contacts):
+            source = 'snapshot'
+        elif bootstrap_node:
+            ip, port = bootstrap_node.split(':')
+            if await self._crawl_from([(ip, int(port))]):
+                source = 'configured'
+        self.startup = {
+            'source': source,
+            'snapshot_contacts': len(contacts),
+            'first_lookup': round(time.monotonic() - started, 3) if source else None,
+        }
+        return source
+
+    # -------- Notifications ---------
+    # Peers poke each other directly over the Kademlia UDP socket using the
+    # address published under ``address:<user>``. Notifications are only
+    # hints; polling stays as a fallback.
+
+    def subscribe(self, callback):
+        """Call ``callback(kind, username)`` on the peer loop when poked.
+
+        ``kind`` is ``'message'`` for new inbox entries and ``'post'`` for a
+        new post by a watched user (or by ourselves).
+        """
+        self.listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def _notified(self, kind, username):
+        if kind == 'message':
+            self.inbox_senders.add(username)
+        if kind == 'post' and username != self.username:
+            self.cache.invalidate('head', f'posts:{username}')
+        for callback in list(self.listeners):
+            callback(kind, username)
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, username):
+        addr = await self._cached_get('address', f'address:{username}', decode=check_address)
+        if not addr:
+            return None
+        host, port = addr.rsplit(':', 1)
+        # Older versions published localhost, which only works on one host.
+        return ('127.0.0.1' if host == 'localhost' else host, int(port))
+
+    def _published_host(self, ip):
+        """Whether a node at ``ip`` can reach the address we published."""
+        published = self._published[1]
+        return published is None or ip.startswith('127.') or not published.startswith('127.')
+
+    def _public_host(self):
+        """The local IP other nodes reach us at.
+
+        Taken from the route to a neighbour, remote ones first, so nodes on
+        other hosts can poke us; 127.0.0.1 while we know nobody else.
+        """
+        ips = {n.ip for n in self.server.protocol.router.find_neighbors(self.server.node)}
+        for ip in sorted(ips, key=lambda ip: ip.startswith('127.') or ip == 'localhost'):
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+                    probe.connect((ip, 9))  # UDP: picks a route, sends nothing
+                    return probe.getsockname()[0]
+            except OSError:
+                continue
+        return '127.0.0.1'
+
+    async def _poke(self, addr, kind):
+        if addr:
+            await self.server.protocol.notify(addr, kind, self.username)
+
+    async def notify_user(self, username, kind):
+        await self._poke(await self._resolve(username), kind)
+
+    async def watch(self, username):
+        """Ask ``username``'s node to notify us of new posts for a while."""
+        addr = await self._resolve(username)
+        if not addr:
+            return False
+        ok, _ = await self.server.protocol.watch(addr)
+        return ok
+
+    def _notify_watchers(self):
+        now = time.monotonic()
+        for addr, expires in list(self.watchers.items()):
+            if expires < now:
+                del self.watchers[addr]
+            else:
+                self._spawn(self._poke(addr, 'post'))
+
+    def _op(self):
+        """The operation being recorded for hooks, or ``None``."""
+        return _current_op.get() if self.hooks is not None else None
+
+    async def _get(self, key):
+        value = await self.server.get(key)
+        op = self._op()
+        if op:
+            op.bytes_read += _value_size(value)
+        return value
+
+    async def _set(self, key, value):
+        op = self._op()
+        if op:
+            op.bytes_written += _value_size(value)
+        return await self.server.set(key, value)
+
+    async def _cached_get(self, kind, key, version=None, decode=None):
+        """Read ``key`` through the local cache.
+
+        With ``decode`` the decoded value is returned. A value that does not
+        decode is treated as missing and never cached.
+        """
+        raw = self.cache.get(kind, key, version)
+        cached = raw is not None
+        if not cached:
+            raw = await self._get(key)
+        value = raw
+        if decode is not None and raw:
+            try:
+                value = decode(raw)
+            except DECODE_ERRORS:
+                self.cache.invalidate(kind, key)
+                return None
+        if not cached:
+            self.cache.put(kind, key, raw, version)
+        return value
+
+    async def _get_decoded(self, key, decode, default=None):
+        """Read ``key`` past the cache; ``default`` if missing or malformed."""
+        data = await self._get(key)
+        if data:
+            try:
+                return decode(data)
+            except DECODE_ERRORS:
+                pass
+        return default
+
+    async def _cached_set(self, kind, key, value, version=None):
+        """Write ``key`` and cache the value, if it reached another node."""
+        stored = await self._set(key, value)
+        if stored:
+            self.cache.put(kind, key, value, version)
+        else:
+            self.cache.invalidate(kind, key)
+        return stored
+
+    async def _get_names(self, key):
+        """The names in the ``names`` set at ``key``, read past the cache."""
+        return await self._get_decoded(key, decode_names, [])
+
+    async def _join_names(self, key, retries):
+        """Make sure the ``names`` set at ``key`` lists us.
+
+        Nodes merge these sets on store; a write that still lost a race,
+        e.g. to a node running an older version, is repeated.
+        """
+        for attempt in range(retries):
+            names = await self._get_names(key)
+            if self.username in names:
+                return
+            if attempt and self._op():
+                self._op().retries += 1
+            await self._set(key, codec.encode('names', {'names': names + [self.username]}))
+            await asyncio.sleep(random.uniform(0, 0.05 * (attempt + 1)))
+
+    # -------- Profile persistence ---------
+    # Edits go through update_profile, which marks fields dirty and
+    # schedules one debounced publish. publish_profile skips the DHT write
+    # and save_profile the disk write when the content hash is unchanged.
+
+    @staticmethod
+    def _content_hash(data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    def update_profile(self, **fields):
+        """Change profile fields; publishing and saving are debounced."""
+        changed = {name for name, value in fields.items() if getattr(self.profile, name) != value}
+        for name in changed:
+            setattr(self.profile, name, fields[name])
+        if changed:
+            self.dirty_fields |= changed
+            self.profile.version += 1
+            self.search.add_profile(self.profile)
+            self._schedule_profile_flush()
+
+    def _seed_search(self):
+        """Index our profile and the profiles and posts restored with the cache.
 
-    async def publish_profile(self):
-        await self.server.set(f'profile:{self.username}', self.profile.to_json())
-        await self.server.set(f'address:{self.username}', f'localhost:{self.port}')
+        Only records that verify against an already pinned key are indexed;
+        records that do not decode are left for the next read to replace.
+        """
+        self.search.add_profile(self.profile)
+        for record in self.cache.values('profile'):
+            try:
+                profile, data, sig = self._open_profile(record)
+            except DECODE_ERRORS:
+                continue
+            if sig and self.verifier.verify_now([self._profile_check(profile, data, sig)])[0]:
+                self.search.add_profile(profile)
+        for chunk in self.cache.values('chunk'):
+            try:
+                posts = decode_posts(chunk)
+            except DECODE_ERRORS:
+                continue
+            checks = [(self.keyring.get(p.author), p.payload(), p.sig) for p in posts]
+            self.search.add_posts(p for p, ok in zip(posts, self.verifier.verify_now(checks))
+                                  if ok and self._post_intact(p, p.author))
+
+    def _schedule_profile_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # Not started yet; start() publishes everything.
+        if self._flush_handle:
+            self._flush_handle.cancel()
+        self._flush_handle = loop.call_later(
+            PROFILE_DEBOUNCE, lambda: self._spawn(self.publish_profile()))
+
+    @instrumented()
+    async def publish_profile(self, force=False):
+        """Publish profile and address if they changed, or always with ``force``."""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self.profile_unpublished = False
+        record = seal(self.signer, self.profile.to_record())
+        digest = self._content_hash(record)
+        address = f'{self._public_host()}:{self.port}'
+        published_digest, published_address = self._published
+        # Only remember what actually reached another node, so a peer that
+        # started alone publishes again once it has neighbours.
+        if force or digest != published_digest:
+            if not await self._cached_set('profile', f'profile:{self.username}', record):
+                digest = None
+        if force or address != published_address:
+            if not await self._cached_set('address', f'address:{self.username}', address):
+                address = None
+        self._published = (digest, address)
+        self.profile_unpublished = digest is None or address is None
         self.save_profile()
+        self.dirty_fields.clear()
+
+    async def set_media(self, field_name, data: bytes):
+        """Upload ``data`` to the blob store and point ``field_name`` at it.
+
+        Returns the blob reference, or ``None`` (leaving the profile as it
+        was) when the upload did not reach the DHT.
+        """
+        if field_name not in MEDIA_FIELDS:
+            raise ValueError(f'{field_name} is not a media field')
+        ref = await self.blobs.put(data)
+        if ref:
+            self.update_profile(**{field_name: ref})
+        return ref
+
+    async def fetch_media(self, profile, field_name):
+        """Return the bytes of a media field, fetching the blob on demand."""
+        value = getattr(profile, field_name)
+        if is_blob_ref(value):
+            return await self.blobs.get(value)
+        return value.encode('utf-8') if value else None
+
+    async def follow(self, username):
+        if username != self.username and username not in self.profile.following:
+            self.update_profile(following=self.profile.following + [username])
+
+    async def unfollow(self, username):
+        if username in self.profile.following:
+            self.update_profile(following=[u for u in self.profile.following if u != username])
 
     def save_profile(self):
-        if self.profile_path:
+        if not self.profile_path:
+            return
+        data = self.profile.to_json()
+        digest = self._content_hash(data)
+        if digest != self._saved_hash:
             self.profile.save(self.profile_path)
+            self._saved_hash = digest
 
+    @instrumented(found=lambda result: result[0] is not None)
     async def lookup_user(self, username):
-        data = await self.server.get(f'profile:{username}')
-        addr = await self.server.get(f'address:{username}')
-        if data and addr:
-            return Profile.from_json(data), addr
+        profile, addr = await asyncio.gather(
+            self._get_profile(username),
+            self._cached_get('address', f'address:{username}', decode=check_address))
+        if profile and addr:
+            return profile, addr
         return None, None
 
+    # -------- Signatures ---------
+    # Every user signs their records with an Ed25519 key published in their
+    # profile. The first key seen in a correctly self-signed profile is
+    # pinned; later profiles must carry the same key. Users whose profile has
+    # no key (older versions) are trusted unsigned until a key is pinned.
+
+    @staticmethod
+    def _open_profile(value):
+        """``(profile, data, sig)`` of a stored profile."""
+        data, sig = unseal(value)
+        return Profile.from_record(data), data, sig
+
+    def _profile_check(self, profile, data, sig):
+        """The ``(key, payload, sig)`` a sealed profile must verify as."""
+        pinned = self.keyring.get(profile.username)
+        return (profile.key if pinned in (None, profile.key) else None), data, sig
+
+    async def _get_profile(self, username):
+        """Fetch and verify ``username``'s profile; ``None`` if missing or forged."""
+        key = f'profile:{username}'
+        opened = await self._cached_get('profile', key, decode=self._open_profile)
+        if not opened:
+            return None
+        profile, data, sig = opened
+        if profile.username != username:
+            trusted = False
+        elif sig is None:
+            # Older versions neither sign nor publish a key.
+            trusted = not profile.key and self.keyring.get(username) is None
+        else:
+            trusted, = await self.verifier.verify([self._profile_check(profile, data, sig)])
+            trusted = trusted and self.keyring.pin(username, profile.key)
+        if not trusted:
+            self.cache.invalidate('profile', key)
+            return None
+        known = self.search.profiles.get(username)
+        if known is not None and profile.version < known.version:
+            return known  # a stale replica; keep the newer profile already seen
+        self.search.add_profile(profile)
+        return profile
+
+    async def _author_key(self, username):
+        """The key ``username`` signs with.
+
+        ``''`` if their profile carries none, ``None`` if no trusted profile
+        was found.
+        """
+        key = self.keyring.get(username)
+        if key is None:
+            if await self._get_profile(username) is None:
+                return None
+            key = self.keyring.get(username) or ''
+        return key
+
+    @staticmethod
+    def _post_intact(post, author):
+        return post.author == author and post.id == make_post_id(post.author, post.timestamp,
+                                                                 post.text)
+
+    async def _verified_posts(self, author, posts):
+        """Keep the posts that ``author`` really published.
+
+        Returns ``None`` when the author's key cannot be found.
+        """
+        posts = [p for p in posts if self._post_intact(p, author)]
+        key = await self._author_key(author)
+        if not key:
+            return posts if key == '' else None
+        checks = await self.verifier.verify([(key, p.payload(), p.sig) for p in posts])
+        return [p for p, ok in zip(posts, checks) if ok]
+
+    async def _sender_keys(self, senders):
+        senders = list(set(senders))
+        return dict(zip(senders, await asyncio.gather(*(self._author_key(s) for s in senders))))
+
+    async def _verified_messages(self, sealed, keys=None):
+        """Keep the ``(record, data, sig)`` messages really sent to us.
+
+        ``keys`` maps senders to ``_author_key`` results, if already looked up.
+        """
+        if keys is None:
+            keys = await self._sender_keys(record.get('from') for record, _, _ in sealed)
+        checks = await self.verifier.verify(
+            [(keys[record.get('from')], data, sig) for record, data, sig in sealed])
+        return [record for (record, _, _), ok in zip(sealed, checks)
+                if (ok and record.get('to') == self.username) or keys[record.get('from')] == '']
+
+    @staticmethod
+    async def _fan_out(items, func, concurrency):
+        """Yield ``(item, await func(item))`` as results arrive.
+
+        At most ``concurrency`` calls run at once and duplicate items are
+        only looked up once.
+        """
+        limit = asyncio.Semaphore(concurrency)
+
+        async def run(item):
+            async with limit:
+                return item, await func(item)
+
+        for next_done in asyncio.as_completed([run(i) for i in dict.fromkeys(items)]):
+            yield await next_done
+
+    async def lookup_users(self, usernames, concurrency=BATCH_CONCURRENCY):
+        """Yield ``(username, (profile, address))`` for many users at once."""
+        async for item in self._fan_out(usernames, self.lookup_user, concurrency):
+            yield item
+
+    # -------- Inbox ---------
+    # Every message is stored under its own content-addressed key
+    # ``msg:<user>:<hash>``. Each sender lists its messages to a user as
+    # ``[seq, hash, timestamp]`` entries in its own ``inbox:<to>:<from>``
+    # record, so every list has a single writer and concurrent senders
+    # cannot erase each other's entries. ``senders:<user>`` is a ``names``
+    # set of the senders. Older versions kept all entries in a shared
+    # ``inbox:<user>`` index, which is still read as the sender ``''``.
+    # The recipient keeps a cursor per sender and
+    # acknowledges what it has dropped under ``inboxack:<to>:<from>``, so
+    # senders can prune their lists. Lists are only read again when their
+    # sender pokes us, or every INBOX_RECHECK seconds; senders idle for
+    # INBOX_SENDER_IDLE are forgotten until they write again.
+
+    def _load_cursor(self):
+        cursor = {'sources': {}}
+        if self.cursor_path and self.cursor_path.exists():
+            with open(self.cursor_path, 'r', encoding='utf-8') as f:
+                cursor = json.load(f)
+        if 'sources' not in cursor:
+            cursor = {'sources': {'': cursor}}  # one cursor over the old shared index
+        return cursor
+
+    def _save_cursor(self):
+        if self.cursor_path:
+            self.cursor_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.cursor_path, 'w', encoding='utf-8') as f:
+                json.dump(self.inbox_cursor, f)
+
+    def _source_cursor(self, sender):
+        return self.inbox_cursor['sources'].get(sender) or {'seq': 0, 'ids': []}
+
+    def _is_new(self, sender, entry):
+        # Entries below the cursor's seq are read, as are the listed ids.
+        seq, msg_id = entry[:2]
+        cursor = self._source_cursor(sender)
+        return seq >= cursor['seq'] and msg_id not in cursor['ids']
+
+    def _mark_read(self, sender, entries, read_ids):
+        """Advance ``sender``'s cursor past ``read_ids``; the rest stay unread."""
+        cursor = self._source_cursor(sender)
+        unread = [e for e in entries if self._is_new(sender, e) and e[1] not in read_ids]
+        if unread:
+            seq = min(e[0] for e in unread)
+        else:
+            seq = max([cursor['seq']] + [e[0] + 1 for e in entries])
+        unread_ids = {e[1] for e in unread}
+        ids = [e[1] for e in entries if e[0] >= seq and e[1] not in unread_ids]
+        self.inbox_cursor['sources'][sender] = dict(cursor, seq=seq, ids=ids)
+
+    async def _get_senders(self, username: str):
+        return await self._get_names(f'senders:{username}')
+
+    async def _get_legacy_inbox(self):
+        return await self._get_decoded(self.inbox_key, decode_inbox, {'seq': 0, 'entries': []})
+
+    async def _get_outbox(self, to_user: str, sender: str):
+        return await self._get_decoded(f'inbox:{to_user}:{sender}', decode_inbox,
+                                       {'seq': 0, 'entries': []})
+
+    @instrumented()
     async def send_message(self, to_user, message):
-        messages = await self.server.get(f'msg:{to_user}')
-        queue = json.loads(messages) if messages else []
-        queue.append({'from': self.username, 'msg': message})
-        await self.server.set(f'msg:{to_user}', json.dumps(queue))
+        """Store ``message`` for ``to_user`` and return its id.
 
-    async def fetch_messages(self):
-        messages = await self.server.get(f'msg:{self.username}')
-        if messages:
-            await self.server.set(f'msg:{self.username}', json.dumps([]))
-            return json.loads(messages)
-        return []
+        Returns None when it did not reach the DHT. A listing that failed is
+        kept and written again with the next message to the same user.
+        """
+        record = {'from': self.username, 'msg': message,
+                  'ts': datetime.utcnow().isoformat(),
+                  'nonce': random.getrandbits(32), 'to': to_user}
+        body = seal(self.signer, codec.encode('message', record))
+        msg_id = hashlib.sha256(body).hexdigest()
+        if not await self._set(f'msg:{to_user}:{msg_id}', body):
+            return None
+        async with self._outbox_locks.setdefault(to_user, asyncio.Lock()):
+            outbox = self.outboxes.get(to_user) or await self._get_outbox(to_user, self.username)
+            # Millisecond sequence numbers keep increasing across restarts,
+            # even if our last write is not visible yet.
+            seq = max(outbox['seq'] + 1, int(time.time() * 1000))
+            entries = outbox['entries'] + [[seq, msg_id, record['ts']]]
+            if len(entries) > INBOX_PRUNE_THRESHOLD:
+                acked = await self._get_decoded(f'inboxack:{to_user}:{self.username}',
+                                                codec.decode, 0)
+                acked = acked if isinstance(acked, int) else 0
+                entries = [e for e in entries if e[0] > acked]
+            outbox = {'seq': seq, 'entries': entries[-OUTBOX_MAX:]}
+            self.outboxes[to_user] = outbox
+            listed = await self._set(f'inbox:{to_user}:{self.username}', codec.encode(None, outbox))
+        # Recipients also learn senders from notifications and remember
+        # them, so the directory only matters until our message is read.
+        await self._join_names(f'senders:{to_user}', INBOX_WRITE_RETRIES)
+        self._spawn(self.notify_user(to_user, 'message'))
+        return msg_id if listed else None
 
-    async def add_post(self, text: str):
-        posts = await self.server.get(self.post_key)
-        post_list = json.loads(posts) if posts else []
-        post = Post(author=self.username, text=text,
-                    timestamp=datetime.utcnow().isoformat(), likes=0)
-        post_list.append(post.to_dict())
-        await self.server.set(self.post_key, json.dumps(post_list))
-
-    async def fetch_posts(self, username: str):
-        posts = await self.server.get(f'posts:{username}')
-        if posts:
-            return [Post.from_dict(p) for p in json.loads(posts)]
+    async def _fetch_legacy_messages(self):
+        self._legacy_inbox_checked = True
+        messages = await self._get_decoded(f'msg:{self.username}', json.loads, [])
+        records = [record for record in (messages if isinstance(messages, list) else [])
+                   if isinstance(record, dict)
+                   and all(isinstance(record.get(name), str) for name in ('from', 'msg'))]
+        if records:
+            await self._set(f'msg:{self.username}', json.dumps([]))
+            return await self._verified_messages([(record, None, None) for record in records])
         return []
 
-    async def like_post(self, username: str, timestamp: str):
+    async def _inbox_lists(self, full=False):
+        """Entries listed for us, by sender.
+
+        Only the lists of senders that poked us, are new to us, still have
+        unread entries or were not read for INBOX_RECHECK seconds are read;
+        the others are taken from the last read. ``full`` reads them all, as
+        the first call after start does.
+        """
+        listed, legacy = await asyncio.gather(self._get_senders(self.username),
+                                              self._get_legacy_inbox())
+        sources = self.inbox_cursor['sources']
+        senders = set(listed) | self.inbox_senders | set(sources)
+        senders.discard('')
+        full = full or not self.inbox_checked
+        now = time.time()
+        due = sorted(sender for sender in senders
+                     if full or sender in self.inbox_senders
+                     or now - self.inbox_checked.get(sender, 0) > INBOX_RECHECK
+                     or any(self._is_new(sender, e) for e in self.inbox_held.get(sender, ())))
+        self.inbox_senders.difference_update(due)
+        async for sender, outbox in self._fan_out(due, self._read_outbox, BATCH_CONCURRENCY):
+            self.inbox_held[sender] = outbox['entries']
+            self.inbox_checked[sender] = now
+            cursor = sources[sender]
+            if 'active' not in cursor or any(self._is_new(sender, e) for e in outbox['entries']):
+                cursor['active'] = now
+        lists = {'': legacy['entries']}
+        for sender in sorted(senders):
+            lists[sender] = self.inbox_held.get(sender, [])
+        return lists
+
+    async def _read_outbox(self, sender):
+        """Read ``sender``'s list for us, starting a cursor for new senders."""
+        sources = self.inbox_cursor['sources']
+        if sender not in sources:
+            # A sender we forgot starts after what we acknowledged to it.
+            acked = await self._get_decoded(f'inboxack:{self.username}:{sender}', codec.decode, 0)
+            acked = acked if isinstance(acked, int) and acked > 0 else 0
+            sources[sender] = {'seq': acked + 1 if acked else 0, 'ids': [], 'acked': acked}
+        return await self._get_outbox(self.username, sender)
+
+    def _droppable(self, lists):
+        """Read entries whose messages have not been dropped yet."""
+        return [(sender, e) for sender, entries in lists.items() for e in entries
+                if not self._is_new(sender, e)
+                and e[0] > self._source_cursor(sender).get('acked', 0)]
+
+    @instrumented(found=bool)
+    async def fetch_messages(self):
+        """Return new messages as ``{'from', 'msg', 'ts', 'id'}`` dicts."""
+        result = []
+        if not self._legacy_inbox_checked:
+            result = await self._fetch_legacy_messages()
+        lists = await self._inbox_lists()
+        fresh = [(sender, e) for sender, entries in lists.items() for e in entries
+                 if self._is_new(sender, e)]
+        if fresh:
+            bodies = await asyncio.gather(
+                *(self._get(f'msg:{self.username}:{entry[1]}') for _, entry in fresh))
+            sealed, malformed = [], []
+            for (sender, entry), body in zip(fresh, bodies):
+                if not body:
+                    continue
+                try:
+                    record, data, sig = open_message(body)
+                except DECODE_ERRORS:
+                    malformed.append((sender, entry[1]))  # dropped like a forged one
+                    continue
+                record['id'] = entry[1]
+                sealed.append((sender, record, data, sig))
+            keys = await self._sender_keys(record.get('from') for _, record, _, _ in sealed)
+            # Messages not fetched, or whose sender's key was not found, are
+            # left unread and tried again next time.
+            sealed = [item for item in sealed if keys[item[1].get('from')] is not None]
+            for record in await self._verified_messages([item[1:] for item in sealed], keys):
+                record.pop('nonce', None)
+                record.pop('to', None)
+                result.append(record)
+            for sender, entries in lists.items():
+                read = {record['id'] for s, record, _, _ in sealed if s == sender}
+                self._mark_read(sender, entries, read | {i for s, i in malformed if s == sender})
+            self._save_cursor()
+        if len(self._droppable(lists)) >= INBOX_PRUNE_THRESHOLD:
+            await self._compact_inbox(lists)
+        return result
+
+    # -------- Post timeline ---------
+    # A timeline is stored as a small head record under ``posts:<user>``
+    # plus fixed-size chunks under ``posts:<user>:<n>``. Publishing only
+    # touches the head and the newest chunk.
+
+    @staticmethod
+    def _chunk_key(username: str, index: int):
+        return f'posts:{username}:{index}'
+
+    async def _get_head(self, username: str, fresh=False):
+        """Return the timeline head for ``username``.
+
+        ``fresh`` bypasses the cache, which writers use so they never append
+        to a stale head. Heads are signed like profiles; one that does not
+        verify is treated as missing.
+
+        Old records stored the whole post list under ``posts:<user>``; in
+        that case the list is returned as ``legacy`` so callers can use it
+        directly.
+        """
         key = f'posts:{username}'
-        posts = await self.server.get(key)
-        if not posts:
+        if fresh:
+            self.cache.invalidate('head', key)
+        opened = await self._cached_get('head', key, decode=open_head)
+        if opened and not await self._head_trusted(username, *opened[2:]):
+            self.cache.invalidate('head', key)
+            opened = None
+        # A replica may be stale, or overwritten by someone else: never go
+        # back behind the head we wrote ourselves.
+        if username == self.username and self.own_head and (
+                opened is None or opened[0].get('count', 0) < self.own_head['count']):
+            return dict(self.own_head), None
+        return opened[:2] if opened else ({'count': 0, 'chunk_size': POSTS_PER_CHUNK}, None)
+
+    async def _head_trusted(self, username, data, sig):
+        key = await self._author_key(username)
+        if sig is None:
+            # Unsigned heads come from older versions: those of users without
+            # a key, and ours until sign_timeline has taken its snapshot.
+            return key == '' or (username == self.username and self.unsigned is not None
+                                 and 'ids' not in self.unsigned)
+        if not key:
             return False
-        posts_list = json.loads(posts)
-        for p in posts_list:
-            if p['timestamp'] == timestamp:
-                p['likes'] = p.get('likes', 0) + 1
-                await self.server.set(key, json.dumps(posts_list))
-                return True
-        return False
+        trusted, = await self.verifier.verify([(key, data, sig)])
+        return trusted
 
-async def main():
-    import argparse
+    async def _put_head(self, head):
+        """Write our own timeline head, signed."""
+        stored = await self._cached_set('head', self.post_key, seal(self.signer, codec.encode(None, head)))
+        if stored:
+            self.own_head = dict(head)
+        return stored
 
-    parser = argparse.ArgumentParser(description="Simple P2P social prototype")
-    parser.add_argument('--username', required=True, help='Your username')
-    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
-    parser.add_argument('--bootstrap', help='bootstrap node address ip:port')
-    parser.add_argument('--lookup', help='Lookup user profile')
-    parser.add_argument('--message', help='Send message text (requires --lookup)')
-    parser.add_argument('--fetch', action='store_true', help='Fetch queued messages')
-    parser.add_argument('--profile-dir', help='Directory to store local profile data')
-    parser.add_argument('--post', help='Text of status update to publish')
-    parser.add_argument('--get-posts', help='Fetch posts from a user')
-    parser.add_argument('--like', nargs=2, metavar=('USER', 'TIMESTAMP'),
-                        help='Like a post from USER with given TIMESTAMP')
-    parser.add_argument('--set-about', help='Update your about section')
-    parser.add_argument('--set-website', help='Update your website URL')
-    parser.add_argument('--set-location', help='Update your location')
-    parser.add_argument('--show-profile', action='store_true', help='Display your profile after updates')
-    args = parser.parse_args()
+    @staticmethod
+    def _chunk_version(head, index):
+        """Number of posts chunk ``index`` holds according to ``head``.
 
-    profile_path = None
-    if args.profile_dir:
-        profile_path = Path(args.profile_dir) / f"{args.username}_profile.json"
-    peer = Peer(args.username, port=args.port, profile_path=profile_path)
-    await peer.start(args.bootstrap)
+        Used as the cache version, so a chunk cached while it was still
+        filling up is refetched once the head says it has grown. Archived
+        chunks carry their likes and are versioned apart (negative).
+        """
+        size = head.get('chunk_size', POSTS_PER_CHUNK)
+        if index < head.get('archived', 0):
+            return -size
+        return max(0, min(size, head.get('count', 0) - index * size))
+
+    async def _get_chunk(self, username: str, index: int, version=None):
+        """The posts stored in a chunk, unverified."""
+        return await self._cached_get('chunk', self._chunk_key(username, index), version,
+                                      decode=decode_posts) or []
+
+    def post_index(self, username: str):
+        index = self.post_indexes.get(username)
+        if index is None:
+            index = self.post_indexes[username] = PostIndex()
+            while len(self.post_indexes) > MAX_INDEXED_AUTHORS:
+                self.post_indexes.popitem(last=False)
+        self.post_indexes.move_to_end(username)
+        return index
+
+    async def _chunk_posts(self, username: str, head, index: int):
+        """Decoded posts of one chunk, from the post index when current."""
+        version = self._chunk_version(head, index)
+        post_index = self.post_index(username)
+        posts = post_index.chunk(index, version)
+        if posts is None:
+            posts = await self._verified_posts(
+                username, await self._get_chunk(username, index, version))
+            if posts is None:
+                return []  # not indexed, so the chunk is checked again later
+            post_index.add_chunk(index, version, posts)
+        return posts
+
+    async def _migrate_legacy_posts(self, legacy: list):
+        head = {'count': len(legacy), 'chunk_size': POSTS_PER_CHUNK}
+        for start in range(0, len(legacy), POSTS_PER_CHUNK):
+            chunk = legacy[start:start + POSTS_PER_CHUNK]
+            await self._cached_set('chunk', self._chunk_key(self.username, start // POSTS_PER_CHUNK),
+                                   codec.encode('post', chunk), len(chunk))
+        if legacy:
+            head['latest'] = legacy[-1]['timestamp']
+        return head
+
+    @instrumented()
+    async def add_post(self, text: str):
+        """Publish a post and return it; ``None`` when it did not reach the DHT."""
+        async with self._timeline_lock:
+            return await self._add_post(text)
+
+    async def _add_post(self, text: str):
+        head, legacy = await self._get_head(self.username, fresh=True)
+        if legacy is not None:
+            head = await self._migrate_legacy_posts(legacy)
+        size = head.get('chunk_size', POSTS_PER_CHUNK)
+        count = head.get('count', 0)
+        index = count // size
+        # A post whose head write failed is stored past the head's count;
+        # it was never published and is overwritten.
+        chunk = (await self._get_chunk(self.username, index, count % size))[:count % size]
+        timestamp = datetime.utcnow().isoformat()
+        post = Post(author=self.username, text=text, timestamp=timestamp, likes=0,
+                    id=make_post_id(self.username, timestamp, text),
+                    sig=self.signer.sign(post_payload(self.username, timestamp, text)))
+        chunk.append(post)
+        if not await self._cached_set('chunk', self._chunk_key(self.username, index),
+                                      codec.encode('post', [p.to_dict() for p in chunk]), len(chunk)):
+            return None
+        head.update(count=count + 1, chunk_size=size, latest=post.timestamp)
+        if not await self._put_head(head):
+            return None
+        self.post_index(self.username).add_chunk(
+            index, len(chunk), await self._verified_posts(self.username, chunk))
+        self.search.add_post(post)
+        self._notify_watchers()
+        self._notified('post', self.username)
+        return post
+
+    async def sign_timeline(self):
+        """Sign the posts we published before we had a signing key.
+
+        Readers holding our key, ourselves included, drop unsigned posts.
+        The first pass that reaches the network records which of our posts
+        are unsigned, and the head listing them, in ``<user>_unsigned_posts``
+        and signs that head; only those posts are ever signed, so posts injected under our name
+        later are not. Passes run on start and from ``maintain`` until every
+        recorded post reads back signed (a node that knew the old chunks may
+        hand them to us while we join), or SIGNING_WINDOW after the key was
+        created.
+        """
+        async with self._timeline_lock:
+            state = self.unsigned
+            if state is None:
+                return
+            if time.time() > state['until']:
+                self._finish_signing()
+                return
+            # Knowing no other node, we could neither read nor write.
+            if not self.server.protocol.router.find_neighbors(self.server.node):
+                return
+            if 'ids' not in state and not await self._snapshot_unsigned(state):
+                return
+            pending = set(state['ids'])
+            head = state['head']
+            size = head.get('chunk_size', POSTS_PER_CHUNK)
+            for index in range(head.get('first', 0), (head.get('count', 0) - 1) // size + 1):
+                if not pending:
+                    break
+                # Read past the cache: it holds what we wrote, not what the
+                # replicas hold.
+                key = self._chunk_key(self.username, index)
+                chunk = await self._get_decoded(key, decode_posts, [])
+                signed = [self._signed(p) if p.id in pending else p for p in chunk]
+                if signed != chunk:
+                    await self._cached_set('chunk', key, codec.encode('post', [p.to_dict() for p in signed]),
+                                           self._chunk_version(head, index))
+                else:
+                    pending -= {p.id for p in chunk}
+            self.post_indexes.pop(self.username, None)
+            if pending:
+                state['ids'] = sorted(pending)
+                self._save_unsigned(state)
+            else:
+                self._finish_signing()
+
+    async def _snapshot_unsigned(self, state):
+        """Record our unsigned posts; False if the timeline could not be read whole."""
+        head, legacy = await self._get_head(self.username, fresh=True)
+        if legacy is not None:
+            posts = [Post.from_dict(p) for p in legacy]
+            ids = {p.id for p in posts if not p.sig and self._post_intact(p, self.username)}
+            # Moved to chunks on the way, as add_post would.
+            head = await self._migrate_legacy_posts(
+                [(self._signed(p) if p.id in ids else p).to_dict() for p in posts])
+            await self._put_head(head)
+        else:
+            if head.get('count'):
+                await self._put_head(head)  # the old head is unsigned
+            ids = set()
+            size = head.get('chunk_size', POSTS_PER_CHUNK)
+            for index in range(head.get('first', 0), (head.get('count', 0) - 1) // size + 1):
+                chunk = await self._get_decoded(self._chunk_key(self.username, index), decode_posts)
+                if chunk is None:
+                    return False  # tried again on the next pass
+                ids.update(p.id for p in chunk if not p.sig and self._post_intact(p, self.username))
+        state.update(ids=sorted(ids), head=head)
+        self._save_unsigned(state)
+        return True
+
+    def _signed(self, post):
+        """``post`` with our signature, which is deterministic."""
+        return replace(post, sig=self.signer.sign(post.payload()))
+
+    def _load_unsigned(self):
+        """What is left of signing our old posts, or ``None`` when done."""
+        if not self.unsigned_marker.exists():
+            return None
+        try:
+            state = json.loads(self.unsigned_marker.read_text(encoding='utf-8') or '{}')
+        except ValueError:
+            state = {}
+        if not isinstance(state, dict) or not isinstance(state.get('until'), (int, float)):
+            # Older versions left an empty marker when they created the key.
+            state = {'until': self.unsigned_marker.stat().st_mtime + SIGNING_WINDOW}
+        return state
+
+    def _save_unsigned(self, state):
+        self.unsigned = state
+        self.unsigned_marker.parent.mkdir(parents=True, exist_ok=True)
+        self.unsigned_marker.write_text(json.dumps(state), encoding='utf-8')
+
+    def _finish_signing(self):
+        self.unsigned = None
+        self.unsigned_marker.unlink(missing_ok=True)
+
+    @instrumented(found=bool)
+    async def fetch_posts(self, username: str, limit: int | None = None,
+                          since: str | None = None, before: str | None = None):
+        """Return posts by ``username`` oldest first.
+
+        ``limit`` keeps only the newest ``limit`` posts, ``since`` only posts
+        with a timestamp after the given ISO string and ``before`` only posts
+        older than it, for paging back through a timeline. Without cursors
+        the needed chunks are known from the head and fetched concurrently;
+        with them chunks are read newest first until the page is complete.
+        """
+        head, legacy = await self._get_head(username)
+        if legacy is not None:
+            posts = await self._verified_posts(username, [Post.from_dict(p) for p in legacy]) or []
+            self.search.add_posts(posts)
+            return self._page(posts, limit, since, before)
+        size = head.get('chunk_size', POSTS_PER_CHUNK)
+        count = head.get('count', 0)
+        oldest = head.get('first', 0)
+        if oldest:
+            self.post_index(username).discard_before(oldest)
+        if since is None and before is None:
+            if limit == 0:
+                count = 0
+            first = max(0, count - limit) // size if limit is not None else 0
+            indexes = list(range(max(first, oldest), (count - 1) // size + 1))
+            chunks = await asyncio.gather(
+                *(self._chunk_posts(username, head, i) for i in indexes))
+        else:
+            indexes, chunks, found = [], [], 0
+            if since and head.get('latest', '') <= since:
+                count = 0
+            index = (count - 1) // size
+            while index >= oldest:
+                chunk = await self._chunk_posts(username, head, index)
+                index -= 1
+                if before and chunk and chunk[0].timestamp >= before:
+                    continue
+                indexes.insert(0, index + 1)
+                chunks.insert(0, chunk)
+                found += sum(1 for p in chunk if not before or p.timestamp < before)
+                if limit is not None and found >= limit:
+                    break
+                if since and chunk and chunk[0].timestamp <= since:
+                    break
+        # Archived chunks already include their likes.
+        archived = head.get('archived', 0)
+        counts = await self._get_like_counts(username, [i for i in indexes if i >= archived])
+        posts = [replace(p, likes=p.likes + counts[p.id]) if p.id in counts else p
+                 for chunk in chunks for p in chunk]
+        self.search.add_posts(posts)
+        return self._page(posts, limit, since, before)
+
+    @staticmethod
+    def _page(posts, limit, since, before=None):
+        if since:
+            posts = [p for p in posts if p.timestamp > since]
+        if before:
+            posts = [p for p in posts if p.timestamp < before]
+        if limit is not None:
+            posts = posts[-limit:] if limit > 0 else []
+        return posts
+
+    async def fetch_posts_many(self, usernames, limit: int | dict | None = None,
+                               since: str | dict | None = None, concurrency=BATCH_CONCURRENCY):
+        """Yield ``(username, posts)`` for many timelines as they arrive.
+
+        ``limit`` and ``since`` may also map usernames to their own values.
+        """
+        async def fetch(username):
+            cursor = since.get(username) if isinstance(since, dict) else since
+            count = limit.get(username) if isinstance(limit, dict) else limit
+            return await self.fetch_posts(username, limit=count, since=cursor)
+
+        async for item in self._fan_out(usernames, fetch, concurrency):
+            yield item
+
+    # -------- Likes ---------
+    # Likes are G-counters with one record per liker and chunk,
+    # ``likes:<user>:<chunk>:<liker>``, mapping post -> count. Only the liker
+    # writes its record and only ever raises its counts, so no like can be
+    # overwritten by another liker. ``likers:<user>:<chunk>`` is a ``names``
+    # set of the chunk's likers, which nodes merge on store; a post's likes
+    # are the sum over their records.
+
+    @staticmethod
+    def _like_key(username: str, index: int, liker: str):
+        return f'likes:{username}:{index}:{liker}'
+
+    @staticmethod
+    def _likers_key(username: str, index: int):
+        return f'likers:{username}:{index}'
+
+    async def _get_like_record(self, key, decode=decode_likes):
+        """A decoded like record or likers set, ``None`` if missing or malformed."""
+        # Most records do not exist; remember that too (as b'') so feed
+        # refreshes do not crawl the network for them every time.
+        data = self.cache.get('likes', key)
+        cached = data is not None
+        if not cached:
+            data = await self._get(key) or b''
+        record = None
+        if data:
+            try:
+                record = decode(data)
+            except DECODE_ERRORS:
+                self.cache.invalidate('likes', key)
+                return None
+        if not cached:
+            self.cache.put('likes', key, data)
+        return record
+
+    async def _get_likers(self, username: str, index: int):
+        return await self._get_like_record(self._likers_key(username, index), decode_names) or []
+
+    async def _get_like_counts(self, username: str, indexes):
+        likers = await asyncio.gather(*(self._get_likers(username, i) for i in indexes))
+        records = await asyncio.gather(
+            *(self._get_like_record(self._like_key(username, i, liker))
+              for i, names in zip(indexes, likers) for liker in names))
+        counts = {}
+        for record in records:
+            for post, count in (record or {}).items():
+                counts[post] = counts.get(post, 0) + count
+        return counts
+
+    async def _like_keys(self, username: str, index: int):
+        """The likers directory of a chunk and the like records it names."""
+        # Past the cache, which may still remember the directory as missing.
+        likers = await self._get_names(self._likers_key(username, index))
+        return [self._likers_key(username, index)] + [
+            self._like_key(username, index, liker) for liker in likers]
+
+    async def _read_like_records(self, username: str, index: int):
+        """A chunk's like records by key, read past the cache.
+
+        Records that do not decode read as ``{}``; those that could not be
+        read at all as ``None``.
+        """
+        keys = (await self._like_keys(username, index))[1:]
+        values = await asyncio.gather(*(self._get(key) for key in keys))
+        records = {}
+        for key, data in zip(keys, values):
+            try:
+                records[key] = decode_likes(data) if data else None
+            except DECODE_ERRORS:
+                records[key] = {}
+        return records
+
+    async def _find_post_chunk(self, username: str, head, post_id: str):
+        oldest = head.get('first', 0)
+        location = self.post_index(username).get(post_id)
+        if location is not None and location[0] >= oldest:
+            return location[0]
+        # Not indexed yet: walk the timeline newest first, indexing as we go.
+        size = head.get('chunk_size', POSTS_PER_CHUNK)
+        for index in range((head.get('count', 0) - 1) // size, oldest - 1, -1):
+            if any(p.id == post_id for p in await self._chunk_posts(username, head, index)):
+                return index
+        return None
+
+    @instrumented(found=bool)
+    async def like_post(self, username: str, post_id: str):
+        # A fresh head, so new posts are found and archived chunks (whose
+        # like records are gone) are never written to.
+        head, legacy = await self._get_head(username, fresh=True)
+        if legacy is not None:
+            for p in legacy:
+                if Post.from_dict(p).id == post_id:
+                    p['likes'] = p.get('likes', 0) + 1
+                    await self._cached_set('head', f'posts:{username}', json.dumps(legacy))
+                    return True
+            return False
+        index = await self._find_post_chunk(username, head, post_id)
+        if index is None or index < head.get('archived', 0):
+            return False
+        key = self._like_key(username, index, self.username)
+        async with self._like_lock:
+            # Start from the larger of what we last wrote and what is stored,
+            # so likes from before a restart are not counted again.
+            record = await self._get_decoded(key, decode_likes, {})
+            for post, count in self.my_likes.get(key, {}).items():
+                record[post] = max(record.get(post, 0), count)
+            record[post_id] = record.get(post_id, 0) + 1
+            self.my_likes[key] = record
+            await self._cached_set('likes', key, codec.encode(None, record))
+        likers_key = self._likers_key(username, index)
+        await self._join_names(likers_key, LIKE_WRITE_RETRIES)
+        self.cache.invalidate('likes', likers_key)  # may remember it without us
+        return True
+
+    # -------- Maintenance ---------
+    # Retention drops whole old chunks of our timeline and old inbox entries
+    # and overwrites the records with TOMBSTONE. Old full chunks are rewritten
+    # as archive segments with their likes folded in, so their like records
+    # can be dropped as well.
+
+    def _schedule_maintenance(self):
+        def run():
+            self._spawn(self.maintain())
+            self._schedule_maintenance()
+
+        self._maintenance_handle = asyncio.get_running_loop().call_later(
+            MAINTENANCE_INTERVAL, run)
+
+    async def _drop(self, keys):
+        await asyncio.gather(*(self._set(key, TOMBSTONE) for key in keys))
+        # kademlia only stores locally when this node is among the closest to
+        # a key, and reads check local storage first: replace copies we host
+        # so our own reads do not bring dropped records back.
+        for key in keys:
+            dkey = dht_digest(key)
+            if self.server.storage.get(dkey) is not None:
+                self.server.storage[dkey] = TOMBSTONE
+
+    @instrumented()
+    async def maintain(self):
+        """Apply retention and compaction to our own timeline and inbox."""
+        await self.sign_timeline()
+        async with self._timeline_lock:
+            archived, dropped = await self._compact_timeline()
+        messages = await self._compact_inbox(await self._inbox_lists(full=True))
+        senders = await self._forget_senders()
+        return {'chunks_archived': archived, 'chunks_dropped': dropped,
+                'messages_dropped': messages, 'senders_forgotten': senders}
+
+    async def _raw_chunk_posts(self, head, index: int):
+        """Every post stored in one of our chunks, verified or not.
+
+        Compaction rewrites chunks from these, so posts we cannot verify at
+        the moment (e.g. not signed yet) are not lost.
+        """
+        return await self._get_chunk(self.username, index, self._chunk_version(head, index))
 
-    updated = False
+    async def _compact_timeline(self):
+        head, legacy = await self._get_head(self.username, fresh=True)
+        if legacy is not None:
+            return 0, 0  # converted to chunks on the next post
+        retention = self.retention
+        size = head.get('chunk_size', POSTS_PER_CHUNK)
+        count = head.get('count', 0)
+        full = count // size  # the chunk still filling up is never touched
+        first = head.get('first', 0)
+        archived = max(head.get('archived', 0), first)
+        new_first = first
+        if retention.max_posts is not None:
+            new_first = max(new_first, (count - retention.max_posts) // size)
+        if retention.max_post_age is not None:
+            cutoff = (datetime.utcnow() - timedelta(seconds=retention.max_post_age)).isoformat()
+            while new_first < full:
+                chunk = await self._raw_chunk_posts(head, new_first)
+                if not chunk or chunk[-1].timestamp >= cutoff:
+                    break  # too new, or unreadable now
+                new_first += 1
+        new_first = min(new_first, full)
+        new_archived = max(archived, new_first)
+        for index in range(new_archived, full - retention.live_chunks):
+            posts = await self._raw_chunk_posts(head, index)
+            if not posts:
+                break  # unreadable now; archived on a later run
+            records = await self._read_like_records(self.username, index)
+            counts = {}
+            for record in records.values():
+                for post, count in (record or {}).items():
+                    counts[post] = counts.get(post, 0) + count
+            segment = [replace(p, likes=p.likes + counts.get(p.id, 0)) for p in posts]
+            # Drop the like records first: readers may briefly miss likes but
+            # never count them twice. Only records folded in are dropped.
+            await self._drop([self._likers_key(self.username, index)] +
+                             [key for key, record in records.items() if record is not None])
+            await self._cached_set('chunk', self._chunk_key(self.username, index),
+                                   codec.encode('post', [p.to_dict() for p in segment]), -size)
+            new_archived = index + 1
+        if (new_first, new_archived) == (first, archived):
+            return 0, 0
+        head.update(first=new_first, archived=new_archived)
+        await self._put_head(head)
+        dropped = range(first, new_first)
+        like_keys = [await self._like_keys(self.username, i) for i in dropped if i >= archived]
+        await self._drop([self._chunk_key(self.username, i) for i in dropped] +
+                         [key for keys in like_keys for key in keys])
+        self.post_index(self.username).discard_before(new_first)
+        return new_archived - max(archived, new_first), len(dropped)
+
+    async def _compact_inbox(self, lists=None):
+        """Drop read messages and unread ones beyond retention.
+
+        Senders' lists are not ours to rewrite: they are acknowledged under
+        ``inboxack:<to>:<from>`` and pruned by their senders. The old shared
+        index is rewritten after merging with a fresh read.
+        """
+        retention = self.retention
+        if lists is None:
+            lists = await self._inbox_lists()
+        unread = sorted(((sender, e) for sender, entries in lists.items() for e in entries
+                         if self._is_new(sender, e)),
+                        key=lambda item: item[1][2] if len(item[1]) > 2 else '')
+        expired = []
+        if retention.max_message_age is not None:
+            cutoff = (datetime.utcnow() - timedelta(seconds=retention.max_message_age)).isoformat()
+            expired = [item for item in unread if len(item[1]) > 2 and item[1][2] < cutoff]
+            unread = [item for item in unread if not (len(item[1]) > 2 and item[1][2] < cutoff)]
+        if retention.max_messages is not None and len(unread) > retention.max_messages:
+            expired += unread[:len(unread) - retention.max_messages]
+        for sender, entries in lists.items():
+            self._mark_read(sender, entries, {e[1] for s, e in expired if s == sender})
+        drop = self._droppable(lists)
+        if not drop:
+            return 0
+        await self._drop([f'msg:{self.username}:{e[1]}' for _, e in drop])
+        for sender, entries in lists.items():
+            if not sender or not entries:
+                continue
+            # Everything up to the first unread entry has been dropped.
+            unread_seqs = [e[0] for e in entries if self._is_new(sender, e)]
+            ack = min(unread_seqs) - 1 if unread_seqs else max(e[0] for e in entries)
+            cursor = self.inbox_cursor['sources'][sender]
+            if ack > cursor.get('acked', 0):
+                await self._set(f'inboxack:{self.username}:{sender}', codec.encode(None, ack))
+                cursor['acked'] = ack
+        legacy = {e[1] for sender, e in drop if not sender}
+        if legacy:
+            inbox = await self._get_legacy_inbox()
+            inbox['entries'] = [e for e in inbox['entries'] if e[1] not in legacy]
+            await self._set(self.inbox_key, codec.encode(None, inbox))
+        self._save_cursor()
+        return len(drop)
+
+    async def _forget_senders(self):
+        """Drop senders idle for INBOX_SENDER_IDLE with everything read and acknowledged."""
+        sources = self.inbox_cursor['sources']
+        now = time.time()
+        idle = {sender for sender, cursor in sources.items()
+                if sender and now - cursor.get('active', now) > INBOX_SENDER_IDLE
+                and not cursor['ids'] and cursor.get('acked', 0) >= cursor['seq'] - 1
+                and not any(self._is_new(sender, e) for e in self.inbox_held.get(sender, ()))}
+        if not idle:
+            return 0
+        for sender in idle:
+            del sources[sender]
+            self.inbox_held.pop(sender, None)
+            self.inbox_checked.pop(sender, None)
+        self._save_cursor()
+        listed = await self._get_senders(self.username)
+        if idle & set(listed):
+            # Nodes unite names sets on store, so the smaller set can only
+            # replace the old one after a tombstone. A sender added meanwhile
+            # adds itself again with its next message.
+            key = f'senders:{self.username}'
+            await self._set(key, TOMBSTONE)
+            await self._set(key, codec.encode('names', {'names': [s for s in listed if s not in idle]}))
+        return len(idle)
+
+
+def print_posts(posts):
+    for data in posts:
+        p = Post.from_dict(data)
+        print(f"[{p.id}] {p.timestamp} - {p.author}: {p.text} ({p.likes} likes)")
+
+
+async def run_commands(args, call):
+    """Carry out the CLI actions through ``call(method, **params)``."""
+    changes = {}
     if args.set_about:
-        peer.profile.about = args.set_about
-        updated = True
+        changes['about'] = args.set_about
     if args.set_website:
-        peer.profile.website = args.set_website
-        updated = True
+        changes['website'] = args.set_website
     if args.set_location:
-        peer.profile.location = args.set_location
-        updated = True
-    if updated:
-        await peer.publish_profile()
-        print('Profile updated.')
+        changes['location'] = args.set_location
+    media = {}
+    if args.set_media:
+        field_name, filename = args.set_media
+        media[field_name] = str(Path(filename).resolve())
+    if changes or media:
+        failed = await call('update_profile', fields=changes, media=media)
+        if failed:
+            print(f"Could not upload {', '.join(failed)}, try again.")
+        else:
+            print('Profile updated.')
+
+    if args.get_media:
+        user, field_name, filename = args.get_media
+        size = await call('get_media', user=user, field=field_name,
+                          filename=str(Path(filename).resolve()))
+        if size:
+            print(f'Saved {size} bytes to {filename}.')
+        else:
+            print('Nothing to save.')
 
     if args.show_profile:
-        print(peer.profile)
+        print(Profile(**await call('profile')))
 
-    if args.post:
-        await peer.add_post(args.post)
-        print('Post published.')
+    if args.follow:
+        await call('follow', user=args.follow)
+        print(f'Following {args.follow}.')
+    if args.unfollow:
+        await call('unfollow', user=args.unfollow)
+        print(f'Unfollowed {args.unfollow}.')
 
-    if args.get_posts:
-        posts = await peer.fetch_posts(args.get_posts)
+    if args.feed:
+        posts = await call('feed', limit=args.limit or 20)
         if posts:
-            for p in posts:
-                print(f"{p.timestamp} - {p.author}: {p.text} ({p.likes} likes)")
+            print_posts(posts)
         else:
-            print('No posts found.')
+            print('Your feed is empty.')
+
+    if args.post:
+        if await call('post', text=args.post):
+            print('Post published.')
+        else:
+            print('Post could not be stored, try again.')
+
+    if args.get_posts:
+        results = await call('get_posts', users=args.get_posts, limit=args.limit, since=args.since)
+        for user, posts in results.items():
+            if posts:
+                print_posts(posts)
+            else:
+                print(f'No posts found for {user}.')
 
     if args.like:
-        user, ts = args.like
-        if await peer.like_post(user, ts):
+        user, post_id = args.like
+        if await call('like', user=user, post_id=post_id):
             print('Post liked.')
         else:
             print('Post not found.')
 
     if args.lookup:
-        profile, addr = await peer.lookup_user(args.lookup)
-        if profile:
+        found = await call('lookup', user=args.lookup)
+        if found['profile']:
             print(f'Profile for {args.lookup}:')
-            print(profile)
-            print(f'Address: {addr}')
+            print(Profile(**found['profile']))
+            print(f"Address: {found['address']}")
             if args.message:
-                await peer.send_message(args.lookup, args.message)
-                print('Message queued.')
+                if await call('message', user=args.lookup, text=args.message):
+                    print('Message queued.')
+                else:
+                    print('Message could not be stored, try again.')
         else:
             print('User not found')
     if args.fetch:
-        msgs = await peer.fetch_messages()
+        msgs = await call('fetch')
         if msgs:
             for m in msgs:
                 print(f"From {m['from']}: {m['msg']}")
         else:
             print('No messages.')
 
-    # keep running to maintain network connection
-    await asyncio.sleep(3600)
+    if args.search:
+        found = await call('search', query=args.search, limit=args.limit or 20)
+        if found['users']:
+            print('Users: ' + ', '.join(found['users']))
+        for match in found['matches']:
+            if match['kind'] == 'post':
+                print_posts([match['record']])
+            else:
+                print(f"@{match['record']['username']}: {match['record']['about']}")
+        if not found['users'] and not found['matches']:
+            print('Nothing found.')
+
+    if args.maintain:
+        print(json.dumps(await call('maintain'), indent=2))
+
+    if args.stats:
+        print(json.dumps(await call('stats'), indent=2))
+
+
+async def main():
+    import argparse
+    from social_daemon import Daemon, DaemonClient, DaemonError, SOCKET_NAME, dispatch
+
+    parser = argparse.ArgumentParser(description="Simple P2P social prototype")
+    parser.add_argument('--username', required=True, help='Your username')
+    parser.add_argument('--port', type=int,
+                        help=f'Port to listen on (default {DEFAULT_PORT}; any free port '
+                             'for further identities in a daemon)')
+    parser.add_argument('--bootstrap', help='bootstrap node address ip:port')
+    parser.add_argument('--lookup', help='Lookup user profile')
+    parser.add_argument('--message', help='Send message text (requires --lookup)')
+    parser.add_argument('--fetch', action='store_true', help='Fetch queued messages')
+    parser.add_argument('--profile-dir', help='Directory to store local profile data')
+    parser.add_argument('--post', help='Text of status update to publish')
+    parser.add_argument('--get-posts', nargs='+', metavar='USER', help='Fetch posts from one or more users')
+    parser.add_argument('--limit', type=int, help='Only fetch the newest LIMIT posts')
+    parser.add_argument('--since', help='Only fetch posts newer than this timestamp')
+    parser.add_argument('--like', nargs=2, metavar=('USER', 'POST_ID'),
+                        help='Like the post POST_ID from USER')
+    parser.add_argument('--set-about', help='Update your about section')
+    parser.add_argument('--set-website', help='Update your website URL')
+    parser.add_argument('--set-location', help='Update your location')
+    parser.add_argument('--set-media', nargs=2, metavar=('FIELD', 'FILE'),
+                        help='Upload FILE as your avatar, wallpaper or resume')
+    parser.add_argument('--get-media', nargs=3, metavar=('USER', 'FIELD', 'FILE'),
+                        help="Save USER's avatar, wallpaper or resume to FILE")
+    parser.add_argument('--show-profile', action='store_true', help='Display your profile after updates')
+    parser.add_argument('--follow', help='Follow a user')
+    parser.add_argument('--unfollow', help='Stop following a user')
+    parser.add_argument('--feed', action='store_true', help='Show newest posts of the users you follow')
+    parser.add_argument('--search', help='Search the profiles and posts this node has seen')
+    parser.add_argument('--stats', action='store_true', help='Print DHT operation statistics after running')
+    parser.add_argument('--keep-posts', type=int, help='Only keep about this many of your newest posts')
+    parser.add_argument('--keep-post-days', type=float, help='Drop your posts older than this many days')
+    parser.add_argument('--keep-messages', type=int, help='Only keep this many unread inbox messages')
+    parser.add_argument('--keep-message-days', type=float,
+                        help='Drop unread inbox messages older than this many days')
+    parser.add_argument('--maintain', action='store_true',
+                        help='Apply retention and compact your timeline and inbox now')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and serve commands from other invocations')
+    parser.add_argument('--socket', help='Daemon socket path (default: data dir/daemon.sock)')
+    args = parser.parse_args()
+
+    data_dir = Path(args.profile_dir) if args.profile_dir else None
+    day = 86400
+    retention = Retention(
+        max_posts=args.keep_posts,
+        max_post_age=args.keep_post_days * day if args.keep_post_days is not None else None,
+        max_messages=args.keep_messages,
+        max_message_age=args.keep_message_days * day if args.keep_message_days is not None else None)
+    socket_path = Path(args.socket) if args.socket else (data_dir or DEFAULT_DATA_DIR) / SOCKET_NAME
+    port = args.port if args.port is not None else DEFAULT_PORT
+
+    if args.daemon:
+        daemon = Daemon(data_dir or DEFAULT_DATA_DIR, socket_path, stats=args.stats,
+                        retention=retention)
+        await daemon.start_identity(args.username, port, args.bootstrap)
+        print(f'Daemon for {args.username} listening on {socket_path}')
+        await daemon.serve()
+        return
+
+    # With a daemon running, commands are forwarded to its warm peer.
+    client = DaemonClient.connect(socket_path)
+    if client:
+        async def call(method, **params):
+            return client.call(args.username, method, **params)
+
+        try:
+            # The daemon may already host someone on the default port, so a
+            # new identity gets a free one unless --port was given.
+            params = {'port': args.port or 0, 'bootstrap': args.bootstrap}
+            if any(value is not None for value in (args.keep_posts, args.keep_post_days,
+                                                   args.keep_messages, args.keep_message_days)):
+                params['retention'] = asdict(retention)
+            await call('start', **params)
+            await run_commands(args, call)
+        except DaemonError as exc:
+            raise SystemExit(f'Error: {exc}')
+        finally:
+            client.close()
+        return
+
+    profile_path = data_dir / f"{args.username}_profile.json" if data_dir else None
+    metrics = Metrics() if args.stats else None
+    peer = Peer(args.username, port=port, profile_path=profile_path, hooks=metrics,
+                retention=retention)
+    await peer.start(args.bootstrap)
+
+    async def call(method, **params):
+        return await dispatch(peer, method, params)
+
+    # Stopping saves the contacts snapshot, cache and other local state,
+    # also when interrupted with Ctrl-C.
+    try:
+        await run_commands(args, call)
+        # keep running to maintain network connection
+        await asyncio.sleep(3600)
+    finally:
+        peer.stop()
 
 if __name__ == '__main__':
     asyncio.run(main())
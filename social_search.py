@@ -0,0 +1,148 @@
+import bisect
+import copy
+import heapq
+import math
+import re
+from collections import OrderedDict
+from itertools import islice
+
+# Posts kept searchable; the oldest indexed are forgotten beyond this.
+SEARCH_MAX_POSTS = 50000
+# Matches ranked per query, most recently indexed first. Bounds the cost of
+# queries for very common words.
+SEARCH_SCAN_LIMIT = 500
+# Profile fields searched by keyword and how much a match in each counts.
+PROFILE_FIELDS = {'username': 3.0, 'about': 1.0, 'location': 1.5}
+POST_WEIGHT = 1.0
+
+TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower()) if text else []
+
+
+class SearchIndex:
+    """Local inverted index over the profiles and posts a peer has seen.
+
+    Usernames are kept sorted for prefix search. Profile fields and post
+    text are split into lowercase words; each word maps to the documents
+    containing it and how often. Documents are ``('profile', username)`` or
+    ``('post', post_id)``. Re-adding a document replaces its terms, so the
+    index can be fed every record as it is fetched.
+    """
+
+    def __init__(self, max_posts=SEARCH_MAX_POSTS):
+        self.max_posts = max_posts
+        self.profiles = {}
+        self.posts = OrderedDict()
+        self.names = []  # sorted (lowercase name, username)
+        self.postings = {}  # term -> {doc: weighted term frequency}
+        self.terms = {}  # doc -> terms, for removal
+
+    # -------- Indexing ---------
+
+    def _index(self, doc, weighted_texts):
+        old = self.terms.pop(doc, ())
+        for term in old:
+            postings = self.postings[term]
+            del postings[doc]
+            if not postings:
+                del self.postings[term]
+        freqs = {}
+        for text, weight in weighted_texts:
+            for term in tokenize(text):
+                freqs[term] = freqs.get(term, 0) + weight
+        for term, freq in freqs.items():
+            self.postings.setdefault(term, {})[doc] = freq
+        self.terms[doc] = tuple(freqs)
+
+    def add_profile(self, profile):
+        username = profile.username
+        if self.profiles.get(username) == profile:
+            return
+        self._add_name(username)
+        # A copy, so later in-place edits of the profile are noticed.
+        self.profiles[username] = copy.copy(profile)
+        self._index(('profile', username),
+                    [(getattr(profile, name), weight) for name, weight in PROFILE_FIELDS.items()])
+
+    def _add_name(self, username):
+        i = bisect.bisect_left(self.names, (username.lower(), username))
+        if i == len(self.names) or self.names[i] != (username.lower(), username):
+            self.names.insert(i, (username.lower(), username))
+
+    def add_post(self, post):
+        known = self.posts.get(post.id)
+        self.posts[post.id] = post  # keeps the latest like count
+        if known is not None:
+            return
+        self._add_name(post.author)
+        self._index(('post', post.id), [(post.text, POST_WEIGHT)])
+        while len(self.posts) > self.max_posts:
+            self._forget_post(next(iter(self.posts)))
+
+    def add_posts(self, posts):
+        for post in posts:
+            self.add_post(post)
+
+    def _forget_post(self, post_id):
+        del self.posts[post_id]
+        self._index(('post', post_id), [])
+        del self.terms[('post', post_id)]
+
+    # -------- Queries ---------
+
+    def users(self, prefix, limit=20):
+        """Usernames starting with ``prefix`` (any case), in order.
+
+        An exact match sorts first.
+        """
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        start = bisect.bisect_left(self.names, (prefix,))
+        matches = []
+        for name, username in islice(self.names, start, start + limit):
+            if not name.startswith(prefix):
+                break
+            matches.append(username)
+        return matches
+
+    def search(self, query, limit=20, scan_limit=SEARCH_SCAN_LIMIT):
+        """Return ``(kind, record)`` pairs matching every word of ``query``.
+
+        Of the ``scan_limit`` most recently indexed matches, the ``limit``
+        best by tf-idf are returned; ties go to the newer post.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        postings = [self.postings.get(term) for term in terms]
+        if not terms or not all(postings):
+            return []
+        postings.sort(key=len)
+        total = len(self.terms)
+        idfs = [math.log(1 + total / len(p)) for p in postings]
+        scored = []
+        rest = list(zip(postings[1:], idfs[1:]))
+        for doc in reversed(postings[0]):
+            score = postings[0][doc] * idfs[0]
+            for p, idf in rest:
+                other = p.get(doc)
+                if other is None:
+                    break
+                score += other * idf
+            else:
+                scored.append((score, doc))
+                if len(scored) >= scan_limit:
+                    break
+        best = heapq.nlargest(limit, scored, key=lambda item: (item[0], self._time(item[1])))
+        return [(kind, self.profiles[key] if kind == 'profile' else self.posts[key])
+                for _, (kind, key) in best]
+
+    def _time(self, doc):
+        kind, key = doc
+        return self.posts[key].timestamp if kind == 'post' else ''
+
+    def stats(self):
+        return {'profiles': len(self.profiles), 'posts': len(self.posts),
+                'users': len(self.names), 'terms': len(self.postings)}
@@ -0,0 +1,189 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from nacl.exceptions import BadSignatureError
+from nacl.signing import SigningKey, VerifyKey
+
+# Verification results remembered, by record hash.
+VERIFY_CACHE_SIZE = 50000
+# Batches at least this large are verified on a worker thread.
+VERIFY_OFFLOAD = 64
+
+
+def _b64(data: bytes):
+    return base64.b64encode(data).decode('ascii')
+
+
+def record_hash(key: str, payload: bytes, sig: str):
+    """Identify a signed record together with the key it is checked against."""
+    return hashlib.sha256(f'{key}\n{sig}\n'.encode('utf-8') + payload).digest()
+
+
+class Signer:
+    """A user's Ed25519 signing key.
+
+    With a ``path`` the key is created once and kept there, readable only by
+    the owner; without one a throwaway key is used.
+    """
+
+    def __init__(self, path: Path | None = None):
+        self.created = not (path and path.exists())
+        if not self.created:
+            self.key = SigningKey(path.read_bytes())
+        else:
+            self.key = SigningKey.generate()
+            if path:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = path.with_name(path.name + '.tmp')
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(bytes(self.key))
+                os.replace(tmp, path)
+        self.public_key = _b64(bytes(self.key.verify_key))
+
+    def sign(self, payload: bytes):
+        return _b64(self.key.sign(payload).signature)
+
+
+class KeyRing:
+    """Public keys pinned per username, trusted on first use.
+
+    The first key seen in a correctly self-signed profile is kept in
+    ``path``; later records of that user must be signed by the same key.
+    """
+
+    def __init__(self, path: Path | None = None):
+        self.path = path
+        self.keys = {}
+        if path and path.exists():
+            with open(path, 'r', encoding='utf-8') as f:
+                self.keys = json.load(f)
+
+    def get(self, username):
+        return self.keys.get(username)
+
+    def pin(self, username, key):
+        """Pin ``key`` unless another one is pinned; True if ``key`` is trusted."""
+        pinned = self.keys.get(username)
+        if pinned is None:
+            self.keys[username] = pinned = key
+            if self.path:
+                self.save()
+        return pinned == key
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.keys, f)
+        os.replace(tmp, self.path)
+
+
+class Verifier:
+    """Checks signatures in batches and remembers the results.
+
+    Records are ``(key, payload, sig)`` triples. Each is verified once: the
+    result is kept by record hash, so refreshing a page of already seen
+    posts costs no signature checks. Concurrent ``verify`` calls made in the
+    same loop iteration are checked together, on a worker thread when the
+    batch is large. Good results are saved to ``path`` so restarts stay
+    cheap.
+    """
+
+    def __init__(self, path: Path | None = None, max_entries=VERIFY_CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self.results = OrderedDict()
+        self.pending = []
+        self.checked = 0
+        self.reused = 0
+        self.rejected = 0
+
+    @staticmethod
+    def _check(key, payload, sig):
+        try:
+            VerifyKey(base64.b64decode(key)).verify(payload, base64.b64decode(sig))
+            return True
+        except (BadSignatureError, ValueError, TypeError):
+            return False
+
+    def _check_all(self, items):
+        return [self._check(*item) for item in items]
+
+    def _cached(self, item):
+        digest = record_hash(*item)
+        result = self.results.get(digest)
+        if result is not None:
+            self.results.move_to_end(digest)
+            self.reused += 1
+        return result
+
+    def _remember(self, items, results):
+        for item, ok in zip(items, results):
+            self.results[record_hash(*item)] = ok
+            self.checked += 1
+            self.rejected += not ok
+        while len(self.results) > self.max_entries:
+            self.results.popitem(last=False)
+
+    def verify_now(self, items):
+        """Check ``items`` on the calling thread; returns a bool per item."""
+        results = [self._cached(item) if item[0] and item[2] else False for item in items]
+        missing = [item for item, ok in zip(items, results) if ok is None]
+        if missing:
+            checked = dict(zip(missing, self._check_all(missing)))
+            self._remember(list(checked), list(checked.values()))
+            results = [checked[item] if ok is None else ok for item, ok in zip(items, results)]
+        return results
+
+    async def verify(self, items):
+        """Check ``items``, batched with other concurrent calls."""
+        results = [self._cached(item) if item[0] and item[2] else False for item in items]
+        missing = [item for item, ok in zip(items, results) if ok is None]
+        if not missing:
+            return results
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((missing, future))
+        if len(self.pending) == 1:
+            loop.call_soon(self._flush)
+        checked = iter(await future)
+        return [next(checked) if ok is None else ok for ok in results]
+
+    def _flush(self):
+        batches, self.pending = self.pending, []
+        items = list(dict.fromkeys(item for batch, _ in batches for item in batch))
+        if len(items) < VERIFY_OFFLOAD:
+            self._deliver(batches, items, self._check_all(items))
+            return
+        done = asyncio.get_running_loop().run_in_executor(None, self._check_all, items)
+        done.add_done_callback(lambda f: self._deliver(batches, items, f.result()))
+
+    def _deliver(self, batches, items, results):
+        self._remember(items, results)
+        checked = dict(zip(items, results))
+        for batch, future in batches:
+            if not future.done():
+                future.set_result([checked[item] for item in batch])
+
+    def stats(self):
+        return {'checked': self.checked, 'reused': self.reused, 'rejected': self.rejected}
+
+    def load(self):
+        if self.path and self.path.exists():
+            data = self.path.read_bytes()
+            for i in range(0, len(data) - 31, 32):
+                self.results[data[i:i + 32]] = True
+
+    def save(self):
+        if not self.path:
+            return
+        good = [digest for digest, ok in self.results.items() if ok]
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        tmp.write_bytes(b''.join(good))
+        os.replace(tmp, self.path)
@@ -0,0 +1,123 @@
+import sqlite3
+import time
+from pathlib import Path
+from kademlia.storage import IStorage
+
+# Values older than this are dropped, like kademlia's ForgetfulStorage.
+DEFAULT_TTL = 604800
+# Upper bound on stored values; the oldest are evicted beyond it.
+DEFAULT_MAX_ITEMS = 200000
+# Expired and surplus rows are culled once every this many writes.
+CULL_EVERY = 500
+# Rows read at a time when iterating old values for republishing.
+ITER_PAGE = 256
+
+# DHT values may be any of these types; the tag keeps them round-tripping.
+TYPE_TAGS = {bytes: 0, str: 1, int: 2, float: 3, bool: 4}
+TAG_TYPES = {tag: kind for kind, tag in TYPE_TAGS.items()}
+
+
+def _pack(value):
+    tag = TYPE_TAGS[type(value)]
+    if tag == 0:
+        return tag, value
+    if tag == 1:
+        return tag, value.encode('utf-8')
+    return tag, repr(value).encode('ascii')
+
+
+def _unpack(tag, raw):
+    kind = TAG_TYPES[tag]
+    if kind is bytes:
+        return bytes(raw)
+    text = bytes(raw).decode('utf-8')
+    if kind is str:
+        return text
+    if kind is bool:
+        return text == 'True'
+    return kind(text)
+
+
+class SQLiteStorage(IStorage):
+    """Durable kademlia storage backed by a SQLite file.
+
+    Values survive restarts, expire after ``ttl`` seconds and are bounded to
+    ``max_items`` rows. Rows are indexed by age so republishing can iterate
+    old keys without scanning the table.
+    """
+
+    def __init__(self, path: Path, ttl=DEFAULT_TTL, max_items=DEFAULT_MAX_ITEMS):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.writes = 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # The peer is created on one thread and driven from its loop thread.
+        self.db = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS dht ('
+                        'key BLOB PRIMARY KEY, tag INTEGER, value BLOB, birthday REAL)')
+        # Ordered by birthday, then key, for paging through old values.
+        self.db.execute('DROP INDEX IF EXISTS dht_birthday')
+        self.db.execute('CREATE INDEX IF NOT EXISTS dht_birthday_key ON dht (birthday, key)')
+        self.cull()
+
+    def __setitem__(self, key, value):
+        tag, raw = _pack(value)
+        self.db.execute('INSERT OR REPLACE INTO dht VALUES (?, ?, ?, ?)',
+                        (key, tag, raw, time.time()))
+        self.writes += 1
+        if self.writes % CULL_EVERY == 0:
+            self.cull()
+
+    def cull(self):
+        self.db.execute('DELETE FROM dht WHERE birthday < ?', (time.time() - self.ttl,))
+        surplus = self.db.execute('SELECT COUNT(*) FROM dht').fetchone()[0] - self.max_items
+        if surplus > 0:
+            self.db.execute('DELETE FROM dht WHERE key IN '
+                            '(SELECT key FROM dht ORDER BY birthday LIMIT ?)', (surplus,))
+
+    def get(self, key, default=None):
+        row = self.db.execute('SELECT tag, value FROM dht WHERE key = ? AND birthday >= ?',
+                              (key, time.time() - self.ttl)).fetchone()
+        return _unpack(*row) if row else default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def iter_older_than(self, seconds_old):
+        """Yield ``(key, value)`` for values older than ``seconds_old``.
+
+        Rows are read in pages of ITER_PAGE in birthday order, so the hosted
+        set never has to be held in memory; values republished meanwhile get
+        a new birthday and are not yielded again.
+        """
+        now = time.time()
+        newest, oldest = now - seconds_old, now - self.ttl
+        birthday, key = oldest, b''
+        while True:
+            rows = self.db.execute(
+                'SELECT key, tag, value, birthday FROM dht '
+                'WHERE birthday <= ? AND (birthday > ? OR (birthday = ? AND key > ?)) '
+                'ORDER BY birthday, key LIMIT ?',
+                (newest, birthday, birthday, key, ITER_PAGE)).fetchall()
+            for key, tag, raw, birthday in rows:
+                yield bytes(key), _unpack(tag, raw)
+            if len(rows) < ITER_PAGE:
+                return
+
+    def __iter__(self):
+        rows = self.db.execute('SELECT key, tag, value FROM dht WHERE birthday >= ? '
+                               'ORDER BY birthday', (time.time() - self.ttl,))
+        return ((bytes(key), _unpack(tag, raw)) for key, tag, raw in rows)
+
+    # Deliberately not __len__: kademlia's Server replaces a falsy storage
+    # with its own in-memory one.
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM dht').fetchone()[0]
+
+    def close(self):
+        self.db.close()
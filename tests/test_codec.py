@@ -0,0 +1,57 @@
+import json
+import pytest
+import social_codec as codec
+from social_p2p import Post, Profile
+
+
+def test_record_round_trip_leaves_out_defaults():
+    post = Post(author='alice', text='hello', timestamp='2025-01-01T00:00:00')
+    data = codec.encode('post', post.to_dict())
+    assert data[:1] == codec.MAGIC
+    assert codec.kind_of(data) == 'post'
+    assert b'likes' not in data
+    assert Post.from_dict(codec.decode(data)) == post
+
+
+def test_list_round_trip():
+    posts = [Post(author='bob', text=f'post {i}', timestamp=f'2025-01-01T00:00:{i:02d}').to_dict()
+             for i in range(20)]
+    assert codec.decode(codec.encode('post', posts)) == posts
+
+
+def test_large_payloads_are_compressed():
+    data = codec.encode(None, {'text': 'word ' * 500})
+    assert data[3] & codec.FLAG_ZLIB
+    assert codec.decode(data) == {'text': 'word ' * 500}
+
+
+def test_raw_values_have_no_kind():
+    data = codec.encode(None, {'count': 3, 'chunk_size': 20})
+    assert codec.kind_of(data) is None
+    assert codec.decode(data) == {'count': 3, 'chunk_size': 20}
+
+
+def test_profile_record_round_trip():
+    profile = Profile(username='alice', about='Love P2P', visibility={}, following=['bob'])
+    assert Profile.from_record(profile.to_record()) == profile
+
+
+@pytest.mark.parametrize('value', [
+    json.dumps([{'author': 'carl', 'text': 'old', 'timestamp': '2020'}]),
+    json.dumps({'count': 2}).encode('utf-8'),
+])
+def test_legacy_json_is_read(value):
+    assert codec.decode(value) == json.loads(value)
+
+
+def test_unknown_version_and_tag_are_rejected():
+    data = codec.encode('post', {'author': 'a', 'text': 't', 'timestamp': 'ts'})
+    with pytest.raises(ValueError):
+        codec.decode(data[:1] + bytes((codec.VERSION + 1,)) + data[2:])
+    with pytest.raises(ValueError):
+        codec.decode(data[:2] + bytes((250,)) + data[3:])
+
+
+def test_truncated_record_is_rejected():
+    with pytest.raises(ValueError):
+        codec.decode(codec.MAGIC + b'\x01')
@@ -0,0 +1,101 @@
+import base64
+import json
+import zlib
+import pytest
+import social_codec as codec
+from social_cache import Cache
+from social_p2p import (DECODE_ERRORS, MAX_TIMELINE_POSTS, POSTS_PER_CHUNK, Post, decode_head,
+                        decode_inbox, decode_likes, decode_names, decode_posts, merge_names,
+                        open_head, open_message, unseal)
+
+GARBAGE = [
+    b'',
+    b'\xfe',
+    b'\xfe\x01\x02\x02not zlib',
+    b'\xfe\x01\x00\x00\xc1',
+    b'{not json',
+    b'\xff\xfe\x00',
+    codec.encode(None, 7),
+    codec.encode(None, [1, 2, 3]),
+    codec.encode(None, {'data': 1, 'sig': 2}),
+    codec.encode('signed', {'data': 'text', 'sig': b'bytes'}),
+]
+
+
+@pytest.mark.parametrize('decode', [decode_posts, decode_head, open_head, open_message,
+                                    decode_inbox, decode_names, decode_likes])
+@pytest.mark.parametrize('value', GARBAGE)
+def test_garbage_only_raises_decode_errors(decode, value):
+    # Callers catch DECODE_ERRORS; anything else would escape them.
+    try:
+        decode(value)
+    except DECODE_ERRORS:
+        pass
+
+
+def test_posts_must_have_their_fields():
+    with pytest.raises(DECODE_ERRORS):
+        decode_posts(codec.encode('post', [{'author': 1, 'text': 'x', 'timestamp': 'y'}]))
+    posts = [Post(author='a', text='t', timestamp='ts')]
+    assert decode_posts(codec.encode('post', [p.to_dict() for p in posts])) == posts
+
+
+@pytest.mark.parametrize('head', [
+    {'count': MAX_TIMELINE_POSTS + 1, 'chunk_size': POSTS_PER_CHUNK},
+    {'count': -1},
+    {'count': 5, 'chunk_size': 0},
+    {'count': 5, 'chunk_size': POSTS_PER_CHUNK + 1},
+    {'count': 5, 'first': 2},
+    {'count': 5, 'archived': -1},
+    {'count': '5'},
+])
+def test_heads_out_of_bounds_are_rejected(head):
+    with pytest.raises(ValueError):
+        decode_head(codec.encode(None, head))
+
+
+def test_legacy_head_is_returned_as_list():
+    legacy = [Post(author='a', text='t', timestamp='ts').to_dict()]
+    head, posts = decode_head(json.dumps(legacy))
+    assert head == {'count': 1, 'chunk_size': POSTS_PER_CHUNK}
+    assert posts == legacy
+
+
+def test_unsigned_values_unseal_without_signature():
+    assert unseal(b'plain') == (b'plain', None)
+
+
+def test_inbox_keeps_only_wellformed_entries():
+    data = codec.encode(None, {'seq': 3, 'entries': [[1, 'a', 'ts'], ['x', 'b'], [2], 'junk',
+                                                      [3, 'c']]})
+    assert decode_inbox(data)['entries'] == [[1, 'a', 'ts'], [3, 'c']]
+
+
+def test_likes_keep_positive_counts():
+    data = codec.encode(None, {'p1': 2, 'p2': -1, 'p3': 'x', 4: 1})
+    assert decode_likes(data) == {'p1': 2}
+
+
+def test_names_merge_ignores_garbage():
+    names = codec.encode('names', {'names': ['a']})
+    assert merge_names(names, b'\xfe\x01\x05\x00\xc1') == b'\xfe\x01\x05\x00\xc1'
+    merged = merge_names(names, codec.encode('names', {'names': ['b', 'a']}))
+    assert decode_names(merged) == ['a', 'b']
+
+
+def test_cache_load_skips_damaged_rows(tmp_path):
+    path = tmp_path / 'cache.json'
+    good = ['chunk', 'posts:a:0', 9e12, 1, {'b64': base64.b64encode(b'data').decode()}]
+    path.write_text(json.dumps([good, ['short'], 5, ['chunk', 'k', 9e12, 1, {'text': 'x'}],
+                                ['chunk', ['k'], 9e12, 1, 'x'], ['chunk', 'k2', 'soon', 1, 'x']]))
+    cache = Cache(path=path)
+    cache.load()
+    assert cache.values('chunk') == [b'data']
+    path.write_text('{"rows": 1}')
+    cache = Cache(path=path)
+    cache.load()
+    assert not cache.entries
+
+
+def test_zlib_garbage_is_a_decode_error():
+    assert zlib.error in DECODE_ERRORS
@@ -0,0 +1,71 @@
+import json
+import pytest
+from social_p2p import Peer
+
+
+@pytest.fixture
+def peer(tmp_path):
+    peer = Peer('alice', port=0, profile_path=tmp_path / 'alice_profile.json')
+    yield peer
+    peer.stop()
+
+
+ENTRIES = [[10, 'm1', 'ts1'], [11, 'm2', 'ts2'], [12, 'm3', 'ts3']]
+
+
+def new_ids(peer, sender, entries):
+    return [e[1] for e in entries if peer._is_new(sender, e)]
+
+
+def test_everything_is_new_from_an_unknown_sender(peer):
+    assert new_ids(peer, 'bob', ENTRIES) == ['m1', 'm2', 'm3']
+
+
+def test_cursor_advances_past_read_entries(peer):
+    peer._mark_read('bob', ENTRIES, {'m1', 'm2', 'm3'})
+    assert new_ids(peer, 'bob', ENTRIES) == []
+    assert peer.inbox_cursor['sources']['bob'] == {'seq': 13, 'ids': []}
+    later = ENTRIES + [[13, 'm4', 'ts4']]
+    assert new_ids(peer, 'bob', later) == ['m4']
+
+
+def test_unfetched_entries_stay_unread_and_are_retried(peer):
+    peer._mark_read('bob', ENTRIES, {'m1', 'm3'})
+    assert new_ids(peer, 'bob', ENTRIES) == ['m2']
+    assert peer.inbox_cursor['sources']['bob'] == {'seq': 11, 'ids': ['m3']}
+    peer._mark_read('bob', ENTRIES, {'m2'})
+    assert new_ids(peer, 'bob', ENTRIES) == []
+    assert peer.inbox_cursor['sources']['bob']['seq'] == 13
+
+
+def test_senders_have_separate_cursors(peer):
+    peer._mark_read('bob', ENTRIES, {'m1', 'm2', 'm3'})
+    assert new_ids(peer, 'carol', ENTRIES) == ['m1', 'm2', 'm3']
+
+
+def test_read_entries_are_droppable_until_acknowledged(peer):
+    peer._mark_read('bob', ENTRIES, {'m1', 'm2'})
+    lists = {'bob': ENTRIES}
+    assert [e[1] for _, e in peer._droppable(lists)] == ['m1', 'm2']
+    peer.inbox_cursor['sources']['bob']['acked'] = 11
+    assert peer._droppable(lists) == []
+
+
+def test_cursor_is_saved_and_restored(peer, tmp_path):
+    peer._mark_read('bob', ENTRIES, {'m1'})
+    peer._save_cursor()
+    restored = Peer('alice', port=0, profile_path=tmp_path / 'alice_profile.json')
+    try:
+        assert new_ids(restored, 'bob', ENTRIES) == ['m2', 'm3']
+    finally:
+        restored.stop()
+
+
+def test_old_single_cursor_is_read_as_the_shared_inbox(tmp_path):
+    (tmp_path / 'alice_inbox.json').write_text(json.dumps({'seq': 11, 'ids': []}))
+    peer = Peer('alice', port=0, profile_path=tmp_path / 'alice_profile.json')
+    try:
+        assert new_ids(peer, '', ENTRIES) == ['m2', 'm3']
+        assert new_ids(peer, 'bob', ENTRIES) == ['m1', 'm2', 'm3']
+    finally:
+        peer.stop()
@@ -0,0 +1,53 @@
+from social_p2p import Post, Profile
+from social_search import SearchIndex
+
+
+def post(author, text, second):
+    return Post(author=author, text=text, timestamp=f'2025-01-01T00:00:{second:02d}')
+
+
+def test_every_word_must_match():
+    index = SearchIndex()
+    index.add_posts([post('a', 'red apple', 1), post('b', 'green apple', 2)])
+    assert [r.text for _, r in index.search('apple red')] == ['red apple']
+    assert index.search('apple blue') == []
+    assert index.search('') == []
+
+
+def test_rarer_words_and_usernames_rank_higher():
+    index = SearchIndex()
+    index.add_profile(Profile(username='kite', about='flying things', visibility={}))
+    index.add_posts([post('a', 'I like my kite', 1)] + [post('b', f'common {i}', i) for i in range(5)])
+    kinds = [kind for kind, _ in index.search('kite')]
+    assert kinds == ['profile', 'post']
+    assert index.search('kite', limit=1)[0][1].username == 'kite'
+
+
+def test_ties_go_to_the_newer_post():
+    index = SearchIndex()
+    index.add_posts([post('a', 'same words', 1), post('b', 'same words', 9), post('c', 'same words', 5)])
+    assert [r.author for _, r in index.search('same')] == ['b', 'c', 'a']
+
+
+def test_readding_a_profile_replaces_its_terms():
+    index = SearchIndex()
+    index.add_profile(Profile(username='alice', about='cats', visibility={}))
+    index.add_profile(Profile(username='alice', about='dogs', visibility={}))
+    assert index.search('cats') == []
+    assert index.search('dogs')[0][1].about == 'dogs'
+
+
+def test_oldest_posts_are_forgotten_beyond_the_limit():
+    index = SearchIndex(max_posts=3)
+    index.add_posts(post('a', f'note {i}', i) for i in range(5))
+    assert sorted(r.text for _, r in index.search('note')) == ['note 2', 'note 3', 'note 4']
+    assert index.stats()['posts'] == 3
+
+
+def test_user_prefix_search():
+    index = SearchIndex()
+    for name in ('Bob', 'bobby', 'alice', 'bo'):
+        index.add_profile(Profile(username=name, visibility={}))
+    assert index.users('BO') == ['bo', 'Bob', 'bobby']
+    assert index.users('bob', limit=1) == ['Bob']
+    assert index.users(' ') == []
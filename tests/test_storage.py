@@ -0,0 +1,72 @@
+import pytest
+import social_storage
+from social_storage import SQLiteStorage
+
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(social_storage.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def storage(tmp_path, clock):
+    storage = SQLiteStorage(tmp_path / 'dht.sqlite3', ttl=100, max_items=10)
+    yield storage
+    storage.close()
+
+
+@pytest.mark.parametrize('value', [b'\xfe\x01bytes', 'text', 42, 1.5, True, b''])
+def test_values_round_trip_with_their_type(storage, value):
+    storage[b'key'] = value
+    assert storage.get(b'key') == value
+    assert type(storage.get(b'key')) is type(value)
+
+
+def test_values_expire_after_ttl(storage, clock):
+    storage[b'old'] = b'value'
+    clock.now += 101
+    assert storage.get(b'old') is None
+    with pytest.raises(KeyError):
+        storage[b'old']
+    assert list(storage) == []
+
+
+def test_values_survive_reopening(tmp_path, clock):
+    storage = SQLiteStorage(tmp_path / 'dht.sqlite3')
+    storage[b'key'] = b'value'
+    storage.close()
+    storage = SQLiteStorage(tmp_path / 'dht.sqlite3')
+    assert storage.get(b'key') == b'value'
+    storage.close()
+
+
+def test_cull_keeps_the_newest(storage, clock):
+    for i in range(15):
+        storage[bytes([i])] = i
+        clock.now += 1
+    storage.cull()
+    assert storage.count() == 10
+    assert sorted(value for _, value in storage) == list(range(5, 15))
+
+
+def test_iter_older_than_pages_through_all_old_values(storage, clock, monkeypatch):
+    monkeypatch.setattr(social_storage, 'ITER_PAGE', 3)
+    for i in range(8):
+        storage[bytes([i])] = i
+        if i % 2:
+            clock.now += 1  # pairs share a birthday, so paging must also go by key
+    clock.now += 5
+    storage[b'new'] = 'fresh'
+    old = list(storage.iter_older_than(3))
+    assert sorted(value for _, value in old) == list(range(8))
+    assert len(old) == len({key for key, _ in old})
@@ -1,40 +1,244 @@
 from pathlib import Path
+import os
 import json
+import time
 import asyncio
-from flask import Flask, request, redirect, render_template, session
-from social_p2p import Peer, DEFAULT_PORT
+from dataclasses import asdict
+from quart import Quart, Response, abort, request, redirect, render_template, session, stream_template
+from social_p2p import Peer
+from social_metrics import Metrics
 
-app = Flask(__name__)
+app = Quart(__name__)
 app.secret_key = 'p2psocial'
 
-def get_peer():
-    username = session.get('username')
-    if not username:
-        return None
-    data_dir = Path.home() / '.p2psocial'
-    profile_path = data_dir / f"{username}_profile.json"
-    return Peer(username, port=DEFAULT_PORT, profile_path=profile_path)
+DATA_DIR = Path.home() / '.p2psocial'
+# Peers that have not served a request for this many seconds are stopped.
+PEER_IDLE_TIMEOUT = 600
+SWEEP_INTERVAL = 60
+REQUEST_TIMEOUT = 30
+# Posts shown per page on / and /feed.
+PAGE_SIZE = 20
+# Event streams re-check messages and followed timelines this often even
+# when nothing pokes the peer, and renew their watches on the way.
+EVENTS_POLL_INTERVAL = 60
+# Set P2P_METRICS=1 to record peer operations and serve them on /metrics.
+METRICS_ENABLED = os.environ.get('P2P_METRICS') == '1'
+
+
+class PeerPool:
+    """Started, bootstrapped peers shared by all requests, one per user.
+
+    The peers run on the web server's own event loop, so a page load awaits
+    its DHT round trip instead of holding a worker thread, and costs no
+    node start-up after the first request.
+    """
+
+    def __init__(self, data_dir: Path = DATA_DIR, bootstrap=None,
+                 idle_timeout=PEER_IDLE_TIMEOUT, hooks=None):
+        self.data_dir = data_dir
+        self.hooks = hooks
+        self.bootstrap = bootstrap
+        self.idle_timeout = idle_timeout
+        self.peers = {}
+        self.last_used = {}
+        self.starting = {}
+        self._sweep_handle = None
+
+    async def _start(self, username):
+        profile_path = self.data_dir / f"{username}_profile.json"
+        peer = Peer(username, port=0, profile_path=profile_path, hooks=self.hooks)
+        try:
+            await peer.start(self.bootstrap)
+        except BaseException:
+            peer.stop()  # release its socket and files
+            raise
+        self.peers[username] = peer
+        return peer
+
+    async def get(self, username):
+        peer = self.peers.get(username)
+        if peer is None:
+            task = self.starting.get(username)
+            if task is None:
+                task = asyncio.ensure_future(self._start(username))
+                self.starting[username] = task
+                task.add_done_callback(lambda _: self.starting.pop(username, None))
+            # A request that goes away must not cancel the start others wait for.
+            peer = await asyncio.shield(task)
+        self.touch(username)
+        return peer
+
+    def touch(self, username):
+        self.last_used[username] = time.monotonic()
+
+    def start_sweeping(self):
+        now = time.monotonic()
+        for username, used in list(self.last_used.items()):
+            if now - used > self.idle_timeout:
+                self.evict(username)
+        self._sweep_handle = asyncio.get_running_loop().call_later(
+            SWEEP_INTERVAL, self.start_sweeping)
+
+    def evict(self, username):
+        peer = self.peers.pop(username, None)
+        self.last_used.pop(username, None)
+        if peer:
+            peer.stop()
+
+    def close(self):
+        if self._sweep_handle:
+            self._sweep_handle.cancel()
+        for username in list(self.peers):
+            self.evict(username)
+
+    def cache_stats(self):
+        totals = {'hits': 0, 'misses': 0}
+        for peer in list(self.peers.values()):
+            stats = peer.cache.stats()
+            totals['hits'] += stats['hits']
+            totals['misses'] += stats['misses']
+        return totals
+
+    async def run(self, username, func):
+        """Await ``func(peer)`` for ``username``'s peer, with a timeout."""
+        return await asyncio.wait_for(func(await self.get(username)), REQUEST_TIMEOUT)
+
+
+def load_bootstrap():
+    cfg_path = DATA_DIR / 'config.json'
+    if cfg_path.exists():
+        with open(cfg_path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('bootstrap') or None
+    return None
+
+
+metrics = Metrics() if METRICS_ENABLED else None
+pool = PeerPool(bootstrap=load_bootstrap(), hooks=metrics)
+
+
+@app.before_serving
+async def start_pool():
+    pool.start_sweeping()
+
+@app.after_serving
+async def stop_pool():
+    pool.close()
 
 @app.route('/', methods=['GET', 'POST'])
-def index():
+async def index():
     if request.method == 'POST':
-        username = request.form['username']
+        username = (await request.form)['username']
         session['username'] = username
         return redirect('/')
-    peer = get_peer()
-    if not peer:
-        return render_template('login.html')
-    posts = asyncio.run(peer.fetch_posts(peer.username))
-    return render_template('index.html', username=peer.username, posts=posts)
+    username = session.get('username')
+    if not username:
+        return await render_template('login.html')
+    # ``before`` is the timestamp of the oldest post on the previous page.
+    before = request.args.get('before')
+    posts = await pool.run(username, lambda peer: peer.fetch_posts(
+        username, limit=PAGE_SIZE, before=before))
+    older = posts[0].timestamp if len(posts) == PAGE_SIZE else None
+    return await render_template('index.html', username=username, posts=posts[::-1],
+                                 before=before, older=older)
 
 @app.route('/post', methods=['POST'])
-def post_message():
-    peer = get_peer()
-    if not peer:
+async def post_message():
+    username = session.get('username')
+    if not username:
         return redirect('/')
-    text = request.form['text']
-    asyncio.run(peer.add_post(text))
+    text = (await request.form)['text']
+    if not await pool.run(username, lambda peer: peer.add_post(text)):
+        abort(503)  # not stored; the form can be sent again
     return redirect('/')
 
+@app.route('/feed')
+async def feed():
+    username = session.get('username')
+    if not username:
+        return redirect('/')
+    peer = await pool.get(username)
+    before = request.args.get('before')
+    posts = peer.feed.page(PAGE_SIZE, before)
+    older = posts[-1].timestamp if len(posts) == PAGE_SIZE else None
+    # The first page renders the posts already held at once; new ones
+    # stream in as each followed timeline arrives.
+    fresh = None if before else peer.feed.refresh()
+    return await stream_template('feed.html', username=username, fresh=fresh, posts=posts,
+                                 before=before, older=older)
+
+@app.route('/events')
+async def events():
+    """Server-sent events for new posts and messages of the logged in user.
+
+    ``?kinds=`` picks any of ``post`` (own posts), ``feed`` (posts of
+    followed users) and ``message``; reading messages here marks them read.
+    """
+    username = session.get('username')
+    if not username:
+        abort(401)
+    kinds = set(request.args.get('kinds', 'post,feed,message').split(','))
+    peer = await pool.get(username)
+    pokes = asyncio.Queue()
+
+    def poked(kind, author):
+        pokes.put_nowait((kind, author))
+
+    def event(kind, data):
+        return f'event: {kind}\ndata: {json.dumps(data)}\n\n'
+
+    async def stream():
+        latest = (await peer.fetch_posts(username, limit=1) or [None])[-1]
+        since = latest.timestamp if latest else None
+        peer.subscribe(poked)
+        try:
+            # An initial pass delivers anything missed while disconnected.
+            kind, author = 'poll', None
+            while True:
+                pool.touch(username)
+                if 'message' in kinds and kind in ('message', 'poll'):
+                    for record in await peer.fetch_messages():
+                        yield event('message', record)
+                if 'post' in kinds and (kind == 'poll' or author == username):
+                    posts = await peer.fetch_posts(username, since=since)
+                    for post in posts:
+                        yield event('post', asdict(post))
+                    since = posts[-1].timestamp if posts else since
+                if 'feed' in kinds and (kind == 'poll' or (kind == 'post' and author != username)):
+                    if kind == 'poll':
+                        await asyncio.gather(*(peer.watch(u) for u in peer.feed.following()),
+                                             return_exceptions=True)
+                    async for batch in peer.feed.refresh():
+                        for post in reversed(batch):
+                            yield event('feed', asdict(post))
+                try:
+                    kind, author = await asyncio.wait_for(pokes.get(), EVENTS_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    kind, author = 'poll', None
+                    # A comment line keeps proxies from closing an idle stream.
+                    yield ': keep-alive\n\n'
+        finally:
+            peer.unsubscribe(poked)
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+    response.timeout = None
+    return response
+
+@app.route('/follow', methods=['POST'])
+async def follow():
+    username = session.get('username')
+    if not username:
+        return redirect('/')
+    user = (await request.form)['user'].strip()
+    if user:
+        await pool.run(username, lambda peer: peer.follow(user))
+    return redirect('/feed')
+
+@app.route('/metrics')
+async def metrics_page():
+    if metrics is None:
+        abort(404)
+    return Response(metrics.render_prometheus(pool.cache_stats()), mimetype='text/plain')
+
 if __name__ == '__main__':
     app.run(port=5000)